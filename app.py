@@ -4,15 +4,15 @@ A comprehensive statistical analysis tool for orthopedic and medical informatics
 """
 
 import streamlit as st
-import pandas as pd
-import json
+import orjson
 import os
+import time
+import shutil
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from datetime import datetime
-from council import StatsCouncil
-from execution import CodeExecutor
-from writing import ResultsWriter
 from prompts import PROMPTS
-from journal_formats import JOURNAL_FORMATS
+from journal_formats import JOURNAL_KEYS
 
 # Page configuration
 st.set_page_config(
@@ -98,6 +98,12 @@ def init_session_state():
         'tables': [],
         'total_cost': 0.0,
         'stage_costs': {},
+        'research_question': '',
+        'hypotheses': '',
+        'outcome_var': '',
+        'exposure_var': '',
+        'covariates': '',
+        'additional_context': '',
         'conversation_history': [],
         'analysis_plan_approved': False,
         'assumptions_approved': False,
@@ -110,6 +116,60 @@ def init_session_state():
 
 init_session_state()
 
+# Stage headers for the Analysis tab: (title, subtitle, session key set when complete)
+STAGE_SPECS = (
+    ("Stage 1: Data Audit", "Model: DeepSeek V3.2 | Est. Cost: ~$0.05", 'data_audit'),
+    ("Stage 2: Statistical Planning Council", "Models: DeepSeek V3.2 + DeepSeek R1 + Gemini 2.5 Pro → o3 synthesis | Est. Cost: ~$2.00", 'synthesis'),
+    ("Stage 3: Assumption Verification", "Model: DeepSeek R1 | Est. Cost: ~$0.10", 'assumptions'),
+    ("Stage 4: Code Generation & Execution", "Code: o3 | Verification: DeepSeek R1 | Execution: OpenAI Sandbox | Est. Cost: ~$1.50", 'execution_results'),
+    ("Stage 5: Adversarial Review", "Models: DeepSeek V3.2 + DeepSeek R1 | Est. Cost: ~$0.20", 'adversarial_review'),
+    ("Stage 6: Results Writing", "Model: Claude Opus 4.5 | Est. Cost: ~$4-6", 'results_doc'),
+)
+PROGRESS_STAGES = ("Data Audit", "Planning Council", "Assumptions", "Execution", "Review", "Writing", "Complete")
+STAGE_BOX_TEMPLATE = '<div class="stage-box stage-{status}"><h3>{title}</h3><p>{subtitle}</p></div>'
+
+def render_stage_header(stage: int):
+    """Render the status box for a pipeline stage (0-based, matching current_stage)."""
+    title, subtitle, done_key = STAGE_SPECS[stage]
+    if st.session_state[done_key]:
+        status = "complete"
+    elif st.session_state['current_stage'] == stage:
+        status = "active"
+    else:
+        status = "pending"
+    st.markdown(STAGE_BOX_TEMPLATE.format(status=status, title=title, subtitle=subtitle), unsafe_allow_html=True)
+
+COST_TRACKER_TEMPLATE = '<div class="cost-tracker"><strong>Total Cost:</strong> ${cost:.2f}<br><small>Target: $10-15 per run</small></div>'
+
+def render_cost_tracker(slot):
+    """Write the cost tracker into its placeholder and remember the total that was shown."""
+    cost = st.session_state['total_cost']
+    slot.markdown(COST_TRACKER_TEMPLATE.format(cost=cost), unsafe_allow_html=True)
+    st.session_state['_prev_cost'] = cost
+
+FIGURE_DIR_PREFIX = "stats_council_figures_"
+
+def save_figures(figures: list) -> list:
+    """Write figure bytes to a temp directory and return the file paths."""
+    if not figures:
+        return []
+    fig_dir = tempfile.mkdtemp(prefix=FIGURE_DIR_PREFIX)
+    paths = []
+    for i, fig in enumerate(figures):
+        path = os.path.join(fig_dir, f"figure_{i+1}.png")
+        with open(path, 'wb') as f:
+            f.write(fig)
+        paths.append(path)
+    return paths
+
+def discard_figures(paths: list):
+    """Remove the temp directory written by save_figures for these paths."""
+    if not paths:
+        return
+    fig_dir = os.path.dirname(paths[0])
+    if os.path.basename(fig_dir).startswith(FIGURE_DIR_PREFIX):
+        shutil.rmtree(fig_dir, ignore_errors=True)
+
 # Sidebar configuration
 with st.sidebar:
     st.markdown("## ⚙️ Configuration")
@@ -146,7 +206,7 @@ with st.sidebar:
     st.markdown("### 📰 Journal Format")
     journal = st.selectbox(
         "Target Journal",
-        list(JOURNAL_FORMATS.keys()),
+        JOURNAL_KEYS,
         help="Formatting will follow journal-specific conventions"
     )
     st.session_state['journal'] = journal
@@ -161,29 +221,36 @@ with st.sidebar:
     )
     st.session_state['study_design'] = study_design
     
-    # Cost tracking
+    # Response cache
+    st.markdown("### 🗄️ Response Cache")
+    disable_cache = st.checkbox(
+        "Disable cache",
+        value=st.session_state.get('disable_cache', False),
+        help="Re-running a deterministic stage (temperature ≤ 0.1) or the report writing with identical inputs normally reuses the previous response at no cost"
+    )
+    st.session_state['disable_cache'] = disable_cache
+    
+    # Cost tracking - a stable slot, refreshed again at the end of the run
+    # only if a stage changed the total
     st.markdown("### 💰 Cost Tracker")
-    st.markdown(f"""
-    <div class="cost-tracker">
-        <strong>Total Cost:</strong> ${st.session_state['total_cost']:.2f}<br>
-        <small>Target: $10-15 per run</small>
-    </div>
-    """, unsafe_allow_html=True)
+    cost_slot = st.empty()
+    render_cost_tracker(cost_slot)
     
     # Stage progress
     st.markdown("### 📊 Progress")
-    stages = ["Data Audit", "Planning Council", "Assumptions", "Execution", "Review", "Writing", "Complete"]
     current = st.session_state['current_stage']
-    for i, stage in enumerate(stages):
-        if i < current:
-            st.markdown(f"✅ {stage}")
-        elif i == current:
-            st.markdown(f"🔄 **{stage}**")
-        else:
-            st.markdown(f"⬜ {stage}")
+    progress_lines = [
+        f"✅ {stage}" if i < current else (f"🔄 **{stage}**" if i == current else f"⬜ {stage}")
+        for i, stage in enumerate(PROGRESS_STAGES)
+    ]
+    # Trailing double space forces a markdown line break between entries
+    st.markdown("  \n".join(progress_lines))
     
     # Reset button
     if st.button("🔄 Reset Analysis", type="secondary"):
+        if st.session_state.get('writing_job'):
+            st.session_state['writing_job'].cancel.set()
+        discard_figures(st.session_state.get('figures'))
         for key in list(st.session_state.keys()):
             if key not in ['openrouter_key', 'openai_key']:
                 del st.session_state[key]
@@ -199,10 +266,93 @@ if not st.session_state.get('openrouter_key') or not st.session_state.get('opena
     st.warning("⚠️ Please configure your API keys in the sidebar to begin.")
     st.stop()
 
-# Initialize council and executor
-council = StatsCouncil(st.session_state['openrouter_key'])
-executor = CodeExecutor(st.session_state['openai_key'])
-writer = ResultsWriter(st.session_state['openrouter_key'])
+# Heavy modules are imported only once keys are configured, keeping first paint light
+import pandas as pd
+from council import StatsCouncil
+from execution import CodeExecutor
+from writing import ResultsWriter, WritingJob
+
+@st.cache_data(show_spinner=False)
+def load_csv(file_id: str, _uploaded_file) -> pd.DataFrame:
+    """Parse an uploaded CSV once per file, storing low-cardinality text columns as categoricals."""
+    try:
+        df = pd.read_csv(_uploaded_file, engine="pyarrow")
+    except Exception:
+        # Fall back to the default parser (pyarrow missing or unsupported CSV quirks)
+        _uploaded_file.seek(0)
+        df = pd.read_csv(_uploaded_file)
+    
+    n_rows = max(len(df), 1)
+    for col in df.select_dtypes(include=["object", "string"]).columns:
+        if df[col].nunique(dropna=True) / n_rows < 0.5:
+            df[col] = df[col].astype("category")
+    
+    return df
+
+def _hash_dataframe(df: pd.DataFrame):
+    """
+    Fast cache key for st.cache_data instead of pickling whole frames.
+    Frames live in session_state, so id() is stable across reruns; the shape, dtypes
+    and a hash of the first 100 rows guard against a recycled id.
+    """
+    return (
+        id(df),
+        df.shape,
+        tuple(df.columns),
+        tuple(df.dtypes.astype(str)),
+        pd.util.hash_pandas_object(df.head(100), index=False).values.tobytes()
+    )
+
+DF_HASH = {pd.DataFrame: _hash_dataframe}
+
+@st.cache_data(show_spinner=False, hash_funcs=DF_HASH)
+def preview_rows(df: pd.DataFrame, n: int = 10) -> pd.DataFrame:
+    return df.head(n)
+
+@st.cache_data(show_spinner=False, hash_funcs=DF_HASH)
+def arrow_table(df: pd.DataFrame):
+    """Convert a result table to Arrow once; st.dataframe renders it without re-serializing."""
+    import pyarrow as pa
+    return pa.Table.from_pandas(df)
+
+@st.cache_data(show_spinner=False, hash_funcs=DF_HASH)
+def csv_bytes(df: pd.DataFrame) -> bytes:
+    """CSV download payload for a result table, built once per table content."""
+    return df.to_csv(index=False).encode('utf-8')
+
+@st.cache_data(show_spinner=False, hash_funcs=DF_HASH)
+def column_summary(df: pd.DataFrame) -> pd.DataFrame:
+    """Per-column dtype and missingness table for the Column Summary expander."""
+    n = len(df)
+    isna = df.isna().sum()
+    return pd.DataFrame({
+        'Type': df.dtypes.astype(str),
+        'Non-Null': n - isna,
+        'Null %': (isna / max(n, 1) * 100).round(1)
+    })
+
+# Initialize council and executor once per API key so HTTP clients survive reruns.
+# These instances are shared by every session, so the cache setting is part of the
+# key rather than toggled on a shared instance
+@st.cache_resource
+def get_council(openrouter_key: str, use_cache: bool) -> StatsCouncil:
+    return StatsCouncil(openrouter_key, use_cache=use_cache)
+
+@st.cache_resource
+def get_executor(openai_key: str) -> CodeExecutor:
+    return CodeExecutor(openai_key)
+
+@st.cache_resource
+def get_writer(openrouter_key: str, use_cache: bool) -> ResultsWriter:
+    return ResultsWriter(openrouter_key, use_cache=use_cache)
+
+use_cache = not st.session_state['disable_cache']
+council = get_council(st.session_state['openrouter_key'], use_cache)
+executor = get_executor(st.session_state['openai_key'])
+writer = get_writer(st.session_state['openrouter_key'], use_cache)
+
+# Set while a background writing job is running; triggers a polling rerun at the end
+poll_writing_job = False
 
 # Tab navigation
 tab1, tab2, tab3, tab4 = st.tabs(["📤 Input", "🔬 Analysis", "📄 Results", "📁 Downloads"])
@@ -222,64 +372,77 @@ with tab1:
         
         if uploaded_file is not None:
             try:
-                df = pd.read_csv(uploaded_file)
-                st.session_state['data'] = df
+                # Only re-assign when a different file arrives so reruns keep the same frame
+                if st.session_state.get('data_file_id') != uploaded_file.file_id:
+                    st.session_state['data'] = load_csv(uploaded_file.file_id, uploaded_file)
+                    st.session_state['data_file_id'] = uploaded_file.file_id
+                df = st.session_state['data']
                 st.success(f"✅ Loaded {len(df)} rows × {len(df.columns)} columns")
                 
                 with st.expander("Preview Data", expanded=True):
-                    st.dataframe(df.head(10), use_container_width=True)
+                    st.dataframe(preview_rows(df), use_container_width=True)
                 
                 with st.expander("Column Summary"):
-                    col_info = pd.DataFrame({
-                        'Type': df.dtypes.astype(str),
-                        'Non-Null': df.notna().sum(),
-                        'Null %': (df.isna().sum() / len(df) * 100).round(1)
-                    })
-                    st.dataframe(col_info, use_container_width=True)
+                    st.dataframe(column_summary(df), use_container_width=True)
             except Exception as e:
                 st.error(f"Error loading file: {str(e)}")
     
     with col2:
         st.markdown("### Research Context")
         
-        research_question = st.text_area(
-            "Research Question",
-            placeholder="e.g., Does patient BMI affect 30-day complication rates after primary TKA?",
-            height=100
-        )
-        st.session_state['research_question'] = research_question
-        
-        hypotheses = st.text_area(
-            "Hypotheses (optional)",
-            placeholder="e.g., H1: Higher BMI is associated with increased complication rates\nH0: No association between BMI and complications",
-            height=100
-        )
-        st.session_state['hypotheses'] = hypotheses
-        
-        outcome_var = st.text_input(
-            "Primary Outcome Variable",
-            placeholder="e.g., any_complication, revision, mortality"
-        )
-        st.session_state['outcome_var'] = outcome_var
-        
-        exposure_var = st.text_input(
-            "Primary Exposure/Predictor Variable",
-            placeholder="e.g., bmi, surgical_approach, implant_type"
-        )
-        st.session_state['exposure_var'] = exposure_var
-        
-        covariates = st.text_input(
-            "Key Covariates (comma-separated)",
-            placeholder="e.g., age, sex, asa_class, diabetes"
-        )
-        st.session_state['covariates'] = covariates
+        # Inputs are batched in a form so typing does not rerun the whole script
+        with st.form("research_context", clear_on_submit=False):
+            research_question = st.text_area(
+                "Research Question",
+                value=st.session_state['research_question'],
+                placeholder="e.g., Does patient BMI affect 30-day complication rates after primary TKA?",
+                height=100
+            )
+            
+            hypotheses = st.text_area(
+                "Hypotheses (optional)",
+                value=st.session_state['hypotheses'],
+                placeholder="e.g., H1: Higher BMI is associated with increased complication rates\nH0: No association between BMI and complications",
+                height=100
+            )
+            
+            outcome_var = st.text_input(
+                "Primary Outcome Variable",
+                value=st.session_state['outcome_var'],
+                placeholder="e.g., any_complication, revision, mortality"
+            )
+            
+            exposure_var = st.text_input(
+                "Primary Exposure/Predictor Variable",
+                value=st.session_state['exposure_var'],
+                placeholder="e.g., bmi, surgical_approach, implant_type"
+            )
+            
+            covariates = st.text_input(
+                "Key Covariates (comma-separated)",
+                value=st.session_state['covariates'],
+                placeholder="e.g., age, sex, asa_class, diabetes"
+            )
+            
+            additional_context = st.text_area(
+                "Additional Context",
+                value=st.session_state['additional_context'],
+                placeholder="Any other relevant information about the study, data source, exclusion criteria, etc.",
+                height=100
+            )
+            
+            submitted = st.form_submit_button("💾 Save Research Context")
         
-        additional_context = st.text_area(
-            "Additional Context",
-            placeholder="Any other relevant information about the study, data source, exclusion criteria, etc.",
-            height=100
-        )
-        st.session_state['additional_context'] = additional_context
+        if submitted:
+            st.session_state.update({
+                'research_question': research_question,
+                'hypotheses': hypotheses,
+                'outcome_var': outcome_var,
+                'exposure_var': exposure_var,
+                'covariates': covariates,
+                'additional_context': additional_context,
+            })
+            st.success("✅ Research context saved")
 
 with tab2:
     st.markdown("## Analysis Pipeline")
@@ -290,13 +453,7 @@ with tab2:
     
     # Stage 1: Data Audit
     st.markdown("---")
-    stage1_status = "complete" if st.session_state['data_audit'] else ("active" if st.session_state['current_stage'] == 0 else "pending")
-    st.markdown(f"""
-    <div class="stage-box stage-{stage1_status}">
-        <h3>Stage 1: Data Audit</h3>
-        <p>Model: DeepSeek V3.2 | Est. Cost: ~$0.05</p>
-    </div>
-    """, unsafe_allow_html=True)
+    render_stage_header(0)
     
     if st.session_state['current_stage'] == 0:
         if st.button("🚀 Run Data Audit", type="primary"):
@@ -329,13 +486,7 @@ with tab2:
     
     # Stage 2: Statistical Planning Council
     st.markdown("---")
-    stage2_status = "complete" if st.session_state['synthesis'] else ("active" if st.session_state['current_stage'] == 1 else "pending")
-    st.markdown(f"""
-    <div class="stage-box stage-{stage2_status}">
-        <h3>Stage 2: Statistical Planning Council</h3>
-        <p>Models: DeepSeek V3.2 + DeepSeek R1 + Gemini 2.5 Pro → o3 synthesis | Est. Cost: ~$2.00</p>
-    </div>
-    """, unsafe_allow_html=True)
+    render_stage_header(1)
     
     if st.session_state['current_stage'] >= 1 and not st.session_state['synthesis']:
         if st.button("🧠 Convene Council", type="primary"):
@@ -404,13 +555,7 @@ with tab2:
     
     # Stage 3: Assumption Verification
     st.markdown("---")
-    stage3_status = "complete" if st.session_state['assumptions'] else ("active" if st.session_state['current_stage'] == 2 else "pending")
-    st.markdown(f"""
-    <div class="stage-box stage-{stage3_status}">
-        <h3>Stage 3: Assumption Verification</h3>
-        <p>Model: DeepSeek R1 | Est. Cost: ~$0.10</p>
-    </div>
-    """, unsafe_allow_html=True)
+    render_stage_header(2)
     
     if st.session_state['current_stage'] >= 2 and not st.session_state['assumptions']:
         if st.button("🔍 Verify Assumptions", type="primary"):
@@ -444,36 +589,61 @@ with tab2:
     
     # Stage 4: Code Generation & Execution
     st.markdown("---")
-    stage4_status = "complete" if st.session_state['execution_results'] else ("active" if st.session_state['current_stage'] == 3 else "pending")
-    st.markdown(f"""
-    <div class="stage-box stage-{stage4_status}">
-        <h3>Stage 4: Code Generation & Execution</h3>
-        <p>Code: o3 | Verification: DeepSeek R1 | Execution: OpenAI Sandbox | Est. Cost: ~$1.50</p>
-    </div>
-    """, unsafe_allow_html=True)
+    render_stage_header(3)
     
     if st.session_state['current_stage'] >= 3 and not st.session_state['execution_results']:
         if st.button("⚡ Generate & Execute Analysis", type="primary"):
-            with st.spinner("Generating analysis code..."):
-                # Generate code
-                code, code_cost = council.generate_code(
-                    st.session_state['data'],
-                    st.session_state['synthesis'],
-                    st.session_state['assumptions'],
-                    st.session_state.get('user_modifications', ''),
-                    st.session_state.get('journal', 'Generic')
-                )
-                st.session_state['code'] = code
+            early_code = Future()
+            with ThreadPoolExecutor(max_workers=3) as pool:
+                with st.spinner("Generating analysis code..."):
+                    # Upload the data to the sandbox while o3 writes the code
+                    upload_future = pool.submit(executor.prestage_data, st.session_state['data'])
+                    code_future = pool.submit(
+                        council.draft_code,
+                        st.session_state['data'],
+                        st.session_state['synthesis'],
+                        st.session_state['assumptions'],
+                        st.session_state.get('user_modifications', ''),
+                        st.session_state.get('journal', 'Generic'),
+                        on_code=early_code.set_result
+                    )
+                    # Move on as soon as the code block has streamed; o3 keeps explaining meanwhile
+                    wait([early_code, code_future], return_when=FIRST_COMPLETED)
+                    code = early_code.result() if early_code.done() else code_future.result()[0]
+                    try:
+                        file_id = upload_future.result()
+                    except Exception:
+                        # execute() retries the upload and reports any error
+                        file_id = None
+                
+                with st.spinner("Executing analysis in sandbox..."):
+                    # R1 only annotates the code, so verify it while the sandbox runs
+                    verify_future = pool.submit(council.verify_code, code, st.session_state['synthesis'])
+                    
+                    # Show the sandbox's narration as it streams in
+                    live_output = st.empty()
+                    streamed = []
+                    
+                    def show_progress(delta):
+                        streamed.append(delta)
+                        live_output.markdown(''.join(streamed))
+                    
+                    results, figures, tables, exec_cost = executor.execute(
+                        code,
+                        st.session_state['data'],
+                        file_id=file_id,
+                        on_text=show_progress
+                    )
+                    verification, verify_cost = verify_future.result()
+                
+                code_cost = code_future.result()[1] + verify_cost
+                st.session_state['code'] = council.annotate_code(code, verification)
                 st.session_state['total_cost'] += code_cost
-            
-            with st.spinner("Executing analysis in sandbox..."):
-                # Execute code
-                results, figures, tables, exec_cost = executor.execute(
-                    code,
-                    st.session_state['data']
-                )
                 st.session_state['execution_results'] = results
-                st.session_state['figures'] = figures
+                # Keep paths rather than raw PNG bytes in session state; the
+                # previous run's files are removed rather than left in the temp dir
+                discard_figures(st.session_state['figures'])
+                st.session_state['figures'] = save_figures(figures)
                 st.session_state['tables'] = tables
                 st.session_state['total_cost'] += exec_cost
                 st.session_state['stage_costs']['execution'] = code_cost + exec_cost
@@ -488,14 +658,14 @@ with tab2:
         
         if st.session_state['figures']:
             with st.expander("📈 Figures", expanded=True):
-                for i, fig in enumerate(st.session_state['figures']):
-                    st.image(fig, caption=f"Figure {i+1}")
+                for i, fig_path in enumerate(st.session_state['figures']):
+                    st.image(fig_path, caption=f"Figure {i+1}")
         
         if st.session_state['tables']:
             with st.expander("📋 Tables", expanded=True):
                 for name, table in st.session_state['tables'].items():
                     st.markdown(f"**{name}**")
-                    st.dataframe(table, use_container_width=True)
+                    st.dataframe(arrow_table(table), use_container_width=True)
         
         if st.session_state['current_stage'] == 3:
             col1, col2 = st.columns(2)
@@ -512,13 +682,7 @@ with tab2:
     
     # Stage 5: Adversarial Review
     st.markdown("---")
-    stage5_status = "complete" if st.session_state['adversarial_review'] else ("active" if st.session_state['current_stage'] == 4 else "pending")
-    st.markdown(f"""
-    <div class="stage-box stage-{stage5_status}">
-        <h3>Stage 5: Adversarial Review</h3>
-        <p>Models: DeepSeek V3.2 + DeepSeek R1 | Est. Cost: ~$0.20</p>
-    </div>
-    """, unsafe_allow_html=True)
+    render_stage_header(4)
     
     if st.session_state['current_stage'] >= 4 and not st.session_state['adversarial_review']:
         if st.button("🔎 Run Adversarial Review", type="primary"):
@@ -566,18 +730,20 @@ with tab2:
     
     # Stage 6: Results Writing
     st.markdown("---")
-    stage6_status = "complete" if st.session_state['results_doc'] else ("active" if st.session_state['current_stage'] == 5 else "pending")
-    st.markdown(f"""
-    <div class="stage-box stage-{stage6_status}">
-        <h3>Stage 6: Results Writing</h3>
-        <p>Model: Claude Opus 4.5 | Est. Cost: ~$4-6</p>
-    </div>
-    """, unsafe_allow_html=True)
+    render_stage_header(5)
     
     if st.session_state['current_stage'] >= 5 and not st.session_state['results_doc']:
-        if st.button("✍️ Generate Results Document", type="primary"):
-            with st.spinner("Writing methods and results sections..."):
-                doc_path, cost = writer.generate_results_document(
+        job = st.session_state.get('writing_job')
+        
+        if job is None:
+            if st.session_state.get('generation_cancelled'):
+                st.warning("⏹️ Generation stopped. No document was created.")
+                st.session_state['generation_cancelled'] = False
+            
+            if st.button("✍️ Generate Results Document", type="primary"):
+                # Write on a background thread so the other tabs stay usable meanwhile
+                st.session_state['writing_job'] = WritingJob(
+                    writer,
                     st.session_state['data'],
                     st.session_state['synthesis'],
                     st.session_state['execution_results'],
@@ -587,11 +753,30 @@ with tab2:
                     st.session_state.get('journal', 'Generic'),
                     st.session_state.get('study_design', 'Auto-detect')
                 )
+                st.rerun()
+        
+        elif job.done:
+            del st.session_state['writing_job']
+            if job.result:
+                doc_path, cost = job.result
                 st.session_state['results_doc'] = doc_path
                 st.session_state['total_cost'] += cost
                 st.session_state['stage_costs']['writing'] = cost
                 st.session_state['current_stage'] = 6
-                st.rerun()
+            elif job.cancelled:
+                st.session_state['generation_cancelled'] = True
+            else:
+                st.session_state['writing_error'] = job.error
+            st.rerun()
+        
+        else:
+            st.info("✍️ Writing methods and results sections in the background - you can browse the other tabs meanwhile.")
+            st.button("⏹️ Stop Generation", on_click=job.cancel.set)
+            st.markdown(job.text)
+            poll_writing_job = True
+        
+        if st.session_state.get('writing_error'):
+            st.error(f"Error generating document: {st.session_state.pop('writing_error')}")
     
     if st.session_state['results_doc']:
         st.success("✅ Analysis Complete!")
@@ -610,15 +795,15 @@ with tab3:
         if st.session_state['figures']:
             st.markdown("### Figures")
             cols = st.columns(min(len(st.session_state['figures']), 2))
-            for i, fig in enumerate(st.session_state['figures']):
+            for i, fig_path in enumerate(st.session_state['figures']):
                 with cols[i % 2]:
-                    st.image(fig, caption=f"Figure {i+1}")
+                    st.image(fig_path, caption=f"Figure {i+1}")
         
         if st.session_state['tables']:
             st.markdown("### Tables")
             for name, table in st.session_state['tables'].items():
                 st.markdown(f"**{name}**")
-                st.dataframe(table, use_container_width=True)
+                st.dataframe(arrow_table(table), use_container_width=True)
 
 with tab4:
     st.markdown("## Downloads")
@@ -651,22 +836,22 @@ with tab4:
             st.markdown("### 📊 Data & Figures")
             if st.session_state.get('tables'):
                 for name, table in st.session_state['tables'].items():
-                    csv = table.to_csv(index=False)
                     st.download_button(
                         f"📥 {name} (CSV)",
-                        csv,
+                        csv_bytes(table),
                         file_name=f"{name.lower().replace(' ', '_')}.csv",
                         mime="text/csv"
                     )
             
             if st.session_state.get('figures'):
-                for i, fig in enumerate(st.session_state['figures']):
-                    st.download_button(
-                        f"📥 Figure {i+1} (PNG)",
-                        fig,
-                        file_name=f"figure_{i+1}.png",
-                        mime="image/png"
-                    )
+                for i, fig_path in enumerate(st.session_state['figures']):
+                    with open(fig_path, 'rb') as f:
+                        st.download_button(
+                            f"📥 Figure {i+1} (PNG)",
+                            f,
+                            file_name=f"figure_{i+1}.png",
+                            mime="image/png"
+                        )
         
         # Analysis audit trail
         st.markdown("### 📋 Audit Trail")
@@ -683,7 +868,7 @@ with tab4:
         }
         st.download_button(
             "📥 Audit Trail (JSON)",
-            json.dumps(audit_data, indent=2),
+            orjson.dumps(audit_data, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY),
             file_name="analysis_audit.json",
             mime="application/json"
         )
@@ -696,3 +881,12 @@ st.markdown("""
     Built for orthopedic and medical informatics research
 </div>
 """, unsafe_allow_html=True)
+
+# Stages run after the sidebar renders; only redraw the cost tracker if one of them spent money
+if st.session_state['total_cost'] != st.session_state['_prev_cost']:
+    render_cost_tracker(cost_slot)
+
+# Poll the background writing job after every tab has rendered
+if poll_writing_job:
+    time.sleep(1)
+    st.rerun()
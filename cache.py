@@ -0,0 +1,79 @@
+"""
+Cache module - Disk-backed cache of LLM responses so repeated stages are free.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+from typing import Dict, List, Tuple, Optional
+
+# STATS_COUNCIL_CACHE_DIR overrides the location, e.g. on hosts with a read-only home
+DEFAULT_CACHE_DIR = os.environ.get(
+    "STATS_COUNCIL_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".stats_council", "llm_cache")
+)
+
+
+class ResponseCache:
+    """Exact-match response cache keyed on model, temperature and messages."""
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, enabled: bool = True,
+                 max_temperature: float = 0.1):
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        # Sampled calls (e.g. adversarial review) should give a fresh answer on rerun
+        self.max_temperature = max_temperature
+
+    def accepts(self, temperature: float) -> bool:
+        """Whether a call at this temperature is deterministic enough to cache."""
+        return self.enabled and temperature <= self.max_temperature
+
+    @staticmethod
+    def make_key(model_id: str, messages: List[Dict], temperature: float,
+                 normalize: bool = False) -> str:
+        """
+        Hash the request inputs into a stable cache key.
+        With normalize, runs of whitespace in message text are collapsed so that
+        reflowed or re-indented edits to free-text fields still hit.
+        """
+        if normalize:
+            messages = [
+                {**message, "content": " ".join(str(message.get("content", "")).split())}
+                for message in messages
+            ]
+        raw = json.dumps(
+            {"model": model_id, "messages": messages, "temperature": temperature},
+            sort_keys=True
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        """Return the cached (content, original_cost) for a key, or None on a miss."""
+        if not self.enabled:
+            return None
+
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            return entry['content'], entry['cost']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def set(self, key: str, content: str, cost: float):
+        """Store a response. Failures are ignored - the cache is best effort."""
+        if not self.enabled:
+            return
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Write to a temp file and rename so readers never see partial entries
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'content': content, 'cost': cost}, f)
+            os.replace(temp_path, self._path(key))
+        except OSError:
+            pass
@@ -2,18 +2,57 @@
 Council module - Orchestrates multiple LLMs for statistical planning and verification.
 """
 
-import json
-import requests
-from typing import Dict, List, Tuple, Optional
+import re
+import asyncio
+import httpx
+import orjson
+from itertools import islice
+from typing import Callable, Dict, List, Tuple, Optional
 import pandas as pd
 from prompts import PROMPTS
+from cache import ResponseCache
+from openrouter import read_stream, run_async
+
+# Review/synthesis parsing patterns (case-insensitive substring matches)
+_DISAGREEMENT_RE = re.compile(r'DISAGREEMENT|CONFLICT', re.IGNORECASE)
+_DISAGREEMENT_START_RE = re.compile(r'DISAGREEMENT|CONFLICT|DIFFER', re.IGNORECASE)
+_ISSUE_LINE_RE = re.compile(
+    r'^[^\n]*(?:ERROR|FLAW|INCORRECT|SHOULD|MUST|VIOLATION|MISSING)[^\n]*$',
+    re.IGNORECASE | re.MULTILINE
+)
+# Confidence rubric: phrase -> severity class, matched in a single scan of the review
+_CONFIDENCE_TERMS = {
+    'critical': 'critical', 'severe': 'critical', 'major error': 'critical',
+    'incorrect': 'critical', 'invalid': 'critical',
+    'caution': 'warning', 'consider': 'warning', 'minor': 'warning',
+    'suggest': 'warning', 'could': 'warning',
+}
+_CONFIDENCE_RE = re.compile('|'.join(map(re.escape, _CONFIDENCE_TERMS)), re.IGNORECASE)
 
 class StatsCouncil:
     """Multi-LLM council for statistical analysis planning and verification."""
     
-    def __init__(self, openrouter_api_key: str):
+    def __init__(self, openrouter_api_key: str, use_cache: bool = True):
         self.api_key = openrouter_api_key
         self.base_url = "https://openrouter.ai/api/v1/chat/completions"
+        self.cache = ResponseCache(enabled=use_cache)
+        self._summary_cache = {}
+        
+        # Same for every request, so built once and set as client defaults
+        self._headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": "https://stats-council.streamlit.app",
+            "X-Title": "Stats Council"
+        }
+        
+        # Pooled HTTP/2 client so sequential stages reuse one TLS connection
+        self._client = httpx.Client(
+            http2=True,
+            headers=self._headers,
+            timeout=httpx.Timeout(120.0),
+            limits=httpx.Limits(max_keepalive_connections=16)
+        )
         
         # Model configurations with pricing (per 1M tokens)
         self.models = {
@@ -49,73 +88,193 @@ class StatsCouncil:
             }
         }
     
-    def _call_model(self, model_key: str, messages: List[Dict], temperature: float = 0.1) -> Tuple[str, float]:
-        """Call a model via OpenRouter and return response + cost."""
-        model = self.models[model_key]
-        
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": "https://stats-council.streamlit.app",
-            "X-Title": "Stats Council"
-        }
-        
-        payload = {
-            "model": model['id'],
+    def _build_request(self, model_key: str, messages: List[Dict], temperature: float) -> Dict:
+        """Build the payload for an OpenRouter chat completion (headers live on the clients)."""
+        return {
+            "model": self.models[model_key]['id'],
             "messages": messages,
             "temperature": temperature,
             "max_tokens": 4096
         }
+    
+    def _parse_response(self, model_key: str, result: Dict) -> Tuple[str, float]:
+        """Extract content and cost from an OpenRouter response body."""
+        model = self.models[model_key]
+        content = result['choices'][0]['message']['content']
+        
+        # Calculate cost
+        usage = result.get('usage', {})
+        input_tokens = usage.get('prompt_tokens', 0)
+        output_tokens = usage.get('completion_tokens', 0)
+        cost = (input_tokens * model['input_cost'] / 1_000_000) + (output_tokens * model['output_cost'] / 1_000_000)
+        
+        return content, cost
+    
+    def _stream_response(self, model_key: str, payload: Dict,
+                         on_delta: Callable[[str], None]) -> Tuple[str, float]:
+        """POST a streaming request, passing each text delta to on_delta; returns full text + cost."""
+        payload = {**payload, "stream": True, "stream_options": {"include_usage": True}}
+        with self._client.stream("POST", self.base_url, content=orjson.dumps(payload)) as response:
+            response.raise_for_status()
+            content, usage = read_stream(response, on_delta)
+        
+        return self._parse_response(model_key, {
+            'choices': [{'message': {'content': content}}],
+            'usage': usage
+        })
+    
+    def _call_model(self, model_key: str, messages: List[Dict], temperature: float = 0.1,
+                    loose_cache: bool = False,
+                    on_delta: Optional[Callable[[str], None]] = None) -> Tuple[str, float]:
+        """
+        Call a model via OpenRouter and return response + cost.
+        loose_cache lets whitespace-only prompt edits reuse a cached response.
+        With on_delta the response is streamed and each text delta is passed to it
+        (a cached response arrives as a single delta).
+        """
+        payload = self._build_request(model_key, messages, temperature)
+        
+        # Identical low-temperature requests are served from cache at no cost
+        cache_key = None
+        if self.cache.accepts(temperature):
+            cache_key = self.cache.make_key(payload['model'], messages, temperature, normalize=loose_cache)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                if on_delta is not None:
+                    on_delta(cached[0])
+                return cached[0], 0.0
         
         try:
-            response = requests.post(self.base_url, headers=headers, json=payload, timeout=120)
+            if on_delta is not None:
+                content, cost = self._stream_response(model_key, payload, on_delta)
+            else:
+                response = self._client.post(self.base_url, content=orjson.dumps(payload))
+                response.raise_for_status()
+                content, cost = self._parse_response(model_key, orjson.loads(response.content))
+            if cache_key is not None:
+                self.cache.set(cache_key, content, cost)
+            return content, cost
+        
+        except Exception as e:
+            return f"Error calling {self.models[model_key]['name']}: {str(e)}", 0.0
+    
+    async def _call_model_async(self, client: httpx.AsyncClient, model_key: str,
+                                messages: List[Dict], temperature: float = 0.1) -> Tuple[str, float]:
+        """Async variant of _call_model for fanning out independent requests."""
+        payload = self._build_request(model_key, messages, temperature)
+        
+        cache_key = None
+        if self.cache.accepts(temperature):
+            cache_key = self.cache.make_key(payload['model'], messages, temperature)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached[0], 0.0
+        
+        try:
+            response = await client.post(self.base_url, content=orjson.dumps(payload))
             response.raise_for_status()
-            result = response.json()
-            
-            content = result['choices'][0]['message']['content']
-            
-            # Calculate cost
-            usage = result.get('usage', {})
-            input_tokens = usage.get('prompt_tokens', 0)
-            output_tokens = usage.get('completion_tokens', 0)
-            cost = (input_tokens * model['input_cost'] / 1_000_000) + (output_tokens * model['output_cost'] / 1_000_000)
-            
+            content, cost = self._parse_response(model_key, orjson.loads(response.content))
+            if cache_key is not None:
+                self.cache.set(cache_key, content, cost)
             return content, cost
         
         except Exception as e:
-            return f"Error calling {model['name']}: {str(e)}", 0.0
+            return f"Error calling {self.models[model_key]['name']}: {str(e)}", 0.0
+    
+    def _call_models_concurrently(self, calls: List[Tuple[str, List[Dict], float]]) -> List[Tuple[str, float]]:
+        """
+        Issue several independent model calls at once.
+        Each call is a (model_key, messages, temperature) tuple; results keep the input order.
+        """
+        async def gather_calls(client):
+            return await asyncio.gather(*[
+                self._call_model_async(client, model_key, messages, temperature)
+                for model_key, messages, temperature in calls
+            ])
+        
+        return run_async(gather_calls, self._headers, timeout=120)
+    
+    def _cached_summary(self, df: pd.DataFrame) -> str:
+        """Return _get_data_summary(df), computed once per dataset rather than once per stage."""
+        fingerprint = (
+            id(df), df.shape, tuple(df.columns),
+            int(pd.util.hash_pandas_object(df.head(1000), index=False).sum())
+        )
+        summary = self._summary_cache.get(fingerprint)
+        if summary is None:
+            # Only the active dataset matters; drop summaries of earlier uploads
+            self._summary_cache.clear()
+            summary = self._summary_cache[fingerprint] = self._get_data_summary(df)
+        return summary
     
-    def _get_data_summary(self, df: pd.DataFrame) -> str:
-        """Generate a concise summary of the dataframe for LLM context."""
+    def _get_data_summary(self, df: pd.DataFrame, max_cols: int = 60) -> str:
+        """
+        Generate a concise summary of the dataframe for LLM context.
+        Only the first max_cols columns are described so wide frames keep prompts bounded.
+        """
         summary_parts = []
+        n_rows = max(len(df), 1)
         
         # Basic info
         summary_parts.append(f"Dataset: {len(df)} rows × {len(df.columns)} columns")
         
+        # Null and distinct counts in one vectorized pass over the described columns
+        described = df.iloc[:, :max_cols]
+        null_pcts = (described.isna().sum() / n_rows * 100).tolist()
+        unique_counts = described.nunique().tolist()
+        
+        # Numeric statistics as frame-wide reductions rather than one scan per column and statistic
+        numeric_stats = self._numeric_stats(described)
+        
         # Column info
         summary_parts.append("\nColumns:")
-        for col in df.columns:
-            dtype = str(df[col].dtype)
-            null_pct = (df[col].isna().sum() / len(df) * 100)
-            unique = df[col].nunique()
+        for i, col in enumerate(described.columns):
+            series = described.iloc[:, i]
+            dtype = str(series.dtype)
             
-            if dtype in ['int64', 'float64']:
-                stats = f"mean={df[col].mean():.2f}, std={df[col].std():.2f}, range=[{df[col].min()}, {df[col].max()}]"
+            if i in numeric_stats:
+                mean, std, col_min, col_max = numeric_stats[i]
+                stats = f"mean={mean:.2f}, std={std:.2f}, range=[{col_min}, {col_max}]"
             else:
-                top_vals = df[col].value_counts().head(3).to_dict()
+                # Truncate long category labels (free text, IDs) to keep the digest compact
+                top_vals = {str(k)[:40]: v for k, v in series.value_counts().head(3).items()}
                 stats = f"top values: {top_vals}"
             
-            summary_parts.append(f"  - {col} ({dtype}): {unique} unique, {null_pct:.1f}% null, {stats}")
+            summary_parts.append(f"  - {col} ({dtype}): {unique_counts[i]} unique, {null_pcts[i]:.1f}% null, {stats}")
+        
+        if len(df.columns) > max_cols:
+            remaining = ', '.join(str(col) for col in df.columns[max_cols:])
+            summary_parts.append(f"  ... {len(df.columns) - max_cols} more columns: {remaining}")
         
         return "\n".join(summary_parts)
     
+    @staticmethod
+    def _numeric_stats(df: pd.DataFrame) -> Dict[int, Tuple]:
+        """
+        Map column position -> (mean, std, min, max) for numeric, non-bool columns.
+        min/max are reduced per dtype so integers keep their integer formatting.
+        """
+        positions_by_dtype = {}
+        for i, dtype in enumerate(df.dtypes):
+            if pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype):
+                positions_by_dtype.setdefault(dtype, []).append(i)
+        
+        stats = {}
+        for positions in positions_by_dtype.values():
+            block = df.iloc[:, positions]
+            means, stds = block.mean(), block.std()
+            mins, maxs = block.min(), block.max()
+            for j, i in enumerate(positions):
+                stats[i] = (means.iloc[j], stds.iloc[j], mins.iloc[j], maxs.iloc[j])
+        return stats
+    
     def data_audit(self, df: pd.DataFrame, research_question: str, 
                    outcome_var: str, exposure_var: str) -> Tuple[str, float]:
         """
         Stage 1: Data audit using DeepSeek V3.2
         Returns audit report and cost.
         """
-        data_summary = self._get_data_summary(df)
+        data_summary = self._cached_summary(df)
         
         messages = [
             {"role": "system", "content": PROMPTS['data_audit_system']},
@@ -127,7 +286,8 @@ class StatsCouncil:
             )}
         ]
         
-        return self._call_model('deepseek_v3', messages)
+        # Audit and assumption prompts are driven by free-text fields the user tends to reflow
+        return self._call_model('deepseek_v3', messages, loose_cache=True)
     
     def planning_council(self, df: pd.DataFrame, data_audit: str, research_question: str,
                         hypotheses: str, outcome_var: str, exposure_var: str,
@@ -136,7 +296,7 @@ class StatsCouncil:
         Stage 2: Convene planning council with multiple models.
         Returns individual plans, synthesis, disagreements, and total cost.
         """
-        data_summary = self._get_data_summary(df)
+        data_summary = self._cached_summary(df)
         total_cost = 0.0
         plans = {}
         
@@ -155,28 +315,36 @@ class StatsCouncil:
         # Get proposals from each council member
         council_models = ['deepseek_v3', 'deepseek_r1', 'gemini_25']
         
-        for model_key in council_models:
-            messages = [
-                {"role": "system", "content": PROMPTS['planning_system']},
-                {"role": "user", "content": context}
-            ]
-            response, cost = self._call_model(model_key, messages)
-            plans[self.models[model_key]['name']] = response
-            total_cost += cost
-        
-        # Synthesize with o3
-        synthesis_prompt = PROMPTS['synthesis_prompt'].format(
-            plans=json.dumps(plans, indent=2),
-            research_question=research_question
-        )
-        
         messages = [
-            {"role": "system", "content": PROMPTS['synthesis_system']},
-            {"role": "user", "content": synthesis_prompt}
+            {"role": "system", "content": PROMPTS['planning_system']},
+            {"role": "user", "content": context}
         ]
         
-        synthesis_response, synthesis_cost = self._call_model('o3', messages)
-        total_cost += synthesis_cost
+        async def convene(client):
+            # Council members are independent, so query them concurrently
+            responses = await asyncio.gather(*[
+                self._call_model_async(client, model_key, messages)
+                for model_key in council_models
+            ])
+            for model_key, (response, cost) in zip(council_models, responses):
+                plans[self.models[model_key]['name']] = response
+            
+            # Synthesize with o3 on the same, already-open connection
+            synthesis_prompt = PROMPTS['synthesis_prompt'].format(
+                plans=orjson.dumps(plans, option=orjson.OPT_INDENT_2).decode('utf-8'),
+                research_question=research_question
+            )
+            
+            synthesis_messages = [
+                {"role": "system", "content": PROMPTS['synthesis_system']},
+                {"role": "user", "content": synthesis_prompt}
+            ]
+            
+            synthesis = await self._call_model_async(client, 'o3', synthesis_messages)
+            return responses, synthesis
+        
+        responses, (synthesis_response, synthesis_cost) = run_async(convene, self._headers, timeout=120)
+        total_cost += sum(cost for _, cost in responses) + synthesis_cost
         
         # Extract disagreements (parse from synthesis response)
         disagreements = self._extract_disagreements(synthesis_response)
@@ -185,22 +353,19 @@ class StatsCouncil:
     
     def _extract_disagreements(self, synthesis: str) -> Optional[str]:
         """Extract disagreement section from synthesis response."""
-        if "DISAGREEMENT" in synthesis.upper() or "CONFLICT" in synthesis.upper():
-            # Simple extraction - look for disagreement section
-            lines = synthesis.split('\n')
+        if _DISAGREEMENT_RE.search(synthesis):
+            # Simple extraction - the section runs from the first line mentioning a
+            # disagreement to the next blank line after at least four lines
+            match = _DISAGREEMENT_START_RE.search(synthesis)
+            line_start = synthesis.rfind('\n', 0, match.start()) + 1
             disagreement_lines = []
-            in_disagreement = False
             
-            for line in lines:
-                if any(word in line.upper() for word in ['DISAGREEMENT', 'CONFLICT', 'DIFFER']):
-                    in_disagreement = True
-                if in_disagreement:
-                    disagreement_lines.append(line)
-                    if line.strip() == '' and len(disagreement_lines) > 3:
-                        break
+            for line in synthesis[line_start:].split('\n'):
+                disagreement_lines.append(line)
+                if line.strip() == '' and len(disagreement_lines) > 3:
+                    break
             
-            if disagreement_lines:
-                return '\n'.join(disagreement_lines)
+            return '\n'.join(disagreement_lines)
         
         return None
     
@@ -210,7 +375,7 @@ class StatsCouncil:
         Stage 3: Verify statistical assumptions using DeepSeek R1.
         Returns assumption verification report and cost.
         """
-        data_summary = self._get_data_summary(df)
+        data_summary = self._cached_summary(df)
         
         messages = [
             {"role": "system", "content": PROMPTS['assumptions_system']},
@@ -221,15 +386,29 @@ class StatsCouncil:
             )}
         ]
         
-        return self._call_model('deepseek_r1', messages)
+        return self._call_model('deepseek_r1', messages, loose_cache=True)
     
     def generate_code(self, df: pd.DataFrame, analysis_plan: str, assumptions: str,
                      user_modifications: str, journal_format: str) -> Tuple[str, float]:
         """
-        Stage 4a: Generate analysis code using o3.
+        Stage 4a: Generate analysis code using o3, then verify it with DeepSeek R1.
+        Returns Python code (with any verification notes) and cost.
+        """
+        code, cost = self.draft_code(df, analysis_plan, assumptions, user_modifications, journal_format)
+        verification, verify_cost = self.verify_code(code, analysis_plan)
+        return self.annotate_code(code, verification), cost + verify_cost
+    
+    def draft_code(self, df: pd.DataFrame, analysis_plan: str, assumptions: str,
+                   user_modifications: str, journal_format: str,
+                   on_code: Optional[Callable[[str], None]] = None) -> Tuple[str, float]:
+        """
+        Stage 4a (generation only): o3 writes the analysis code.
+        If on_code is given the response is streamed, and on_code is called once with
+        the code as soon as its ```python block closes, before o3 finishes the
+        explanation that usually follows.
         Returns Python code and cost.
         """
-        data_summary = self._get_data_summary(df)
+        data_summary = self._cached_summary(df)
         column_list = list(df.columns)
         
         messages = [
@@ -244,12 +423,36 @@ class StatsCouncil:
             )}
         ]
         
-        response, cost = self._call_model('o3', messages, temperature=0.0)
+        if on_code is None:
+            response, cost = self._call_model('o3', messages, temperature=0.0)
+            return self._extract_code(response), cost
         
-        # Extract code from response
-        code = self._extract_code(response)
+        parts = []
+        emitted = False
         
-        # Verify code with DeepSeek R1
+        def on_delta(delta):
+            nonlocal emitted
+            parts.append(delta)
+            if emitted or '`' not in delta:
+                return
+            text = ''.join(parts)
+            _, opened, rest = text.partition("```python")
+            if opened and "```" in rest:
+                # The first python block is complete, so this matches the final extraction
+                emitted = True
+                on_code(self._extract_code(text))
+        
+        response, cost = self._call_model('o3', messages, temperature=0.0, on_delta=on_delta)
+        
+        # Extract code from response
+        return self._extract_code(response), cost
+    
+    def verify_code(self, code: str, analysis_plan: str) -> Tuple[str, float]:
+        """
+        Stage 4a (verification only): DeepSeek R1 checks the code against the plan.
+        Independent of execution, so it can run while the code executes.
+        Returns verification report and cost.
+        """
         verify_messages = [
             {"role": "system", "content": PROMPTS['code_verify_system']},
             {"role": "user", "content": PROMPTS['code_verify_user'].format(
@@ -258,28 +461,24 @@ class StatsCouncil:
             )}
         ]
         
-        verification, verify_cost = self._call_model('deepseek_r1', verify_messages)
-        
-        # If verification finds issues, note them but proceed
+        return self._call_model('deepseek_r1', verify_messages)
+    
+    @staticmethod
+    def annotate_code(code: str, verification: str) -> str:
+        """If verification finds issues, note them above the code but proceed."""
         if "ERROR" in verification.upper() or "BUG" in verification.upper():
-            code = f"# VERIFICATION NOTES:\n# {verification[:500]}\n\n{code}"
-        
-        return code, cost + verify_cost
+            return f"# VERIFICATION NOTES:\n# {verification[:500]}\n\n{code}"
+        return code
     
     def _extract_code(self, response: str) -> str:
         """Extract Python code from model response."""
-        # Look for code blocks
-        if "```python" in response:
-            start = response.find("```python") + 9
-            end = response.find("```", start)
-            if end > start:
-                return response[start:end].strip()
-        
-        if "```" in response:
-            start = response.find("```") + 3
-            end = response.find("```", start)
-            if end > start:
-                return response[start:end].strip()
+        # Look for code blocks: a ```python block first, then any fenced block
+        for fence in ("```python", "```"):
+            _, opened, rest = response.partition(fence)
+            if opened:
+                code, closed, _ = rest.partition("```")
+                if closed and code:
+                    return code.strip()
         
         # If no code blocks, return the whole response
         return response
@@ -300,13 +499,17 @@ class StatsCouncil:
             assumptions=assumptions
         )
         
-        # Get adversarial reviews from two models
-        for model_key in ['deepseek_v3', 'deepseek_r1']:
-            messages = [
-                {"role": "system", "content": PROMPTS['adversarial_system']},
-                {"role": "user", "content": review_context}
-            ]
-            response, cost = self._call_model(model_key, messages, temperature=0.7)
+        messages = [
+            {"role": "system", "content": PROMPTS['adversarial_system']},
+            {"role": "user", "content": review_context}
+        ]
+        
+        # Get adversarial reviews from two models concurrently
+        responses = self._call_models_concurrently(
+            [(model_key, messages, 0.7) for model_key in ['deepseek_v3', 'deepseek_r1']]
+        )
+        
+        for response, cost in responses:
             reviews.append(response)
             total_cost += cost
         
@@ -321,32 +524,29 @@ class StatsCouncil:
     
     def _extract_issues(self, review: str) -> Optional[str]:
         """Extract issues from adversarial review."""
-        issue_keywords = ['ERROR', 'FLAW', 'INCORRECT', 'SHOULD', 'MUST', 'VIOLATION', 'MISSING']
-        
-        lines = review.split('\n')
-        issue_lines = []
-        
-        for line in lines:
-            if any(keyword in line.upper() for keyword in issue_keywords):
-                issue_lines.append(line.strip())
+        issue_lines = [match.group(0).strip() for match in islice(_ISSUE_LINE_RE.finditer(review), 10)]
         
         if issue_lines:
-            return '\n'.join(issue_lines[:10])  # Limit to top 10 issues
+            return '\n'.join(issue_lines)  # Limit to top 10 issues
         return None
     
     def _determine_confidence(self, review: str, issues: Optional[str]) -> str:
         """Determine confidence level based on review."""
-        review_lower = review.lower()
-        
-        critical_words = ['critical', 'severe', 'major error', 'incorrect', 'invalid']
-        warning_words = ['caution', 'consider', 'minor', 'suggest', 'could']
-        
-        critical_count = sum(1 for word in critical_words if word in review_lower)
-        warning_count = sum(1 for word in warning_words if word in review_lower)
-        
-        if critical_count >= 2 or (issues and len(issues.split('\n')) > 5):
+        # Many flagged issues decide LOW without scanning the review
+        if issues and issues.count('\n') + 1 > 5:
             return 'LOW'
-        elif critical_count >= 1 or warning_count >= 3:
+        
+        # Count distinct phrases present per class, not occurrences;
+        # a second critical phrase settles LOW, so stop scanning there
+        seen = {'critical': set(), 'warning': set()}
+        for match in _CONFIDENCE_RE.finditer(review):
+            term = match.group(0).lower()
+            found = seen[_CONFIDENCE_TERMS[term]]
+            found.add(term)
+            if len(seen['critical']) >= 2:
+                return 'LOW'
+        
+        if seen['critical'] or len(seen['warning']) >= 3:
             return 'MEDIUM'
         else:
             return 'HIGH'
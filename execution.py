@@ -2,55 +2,55 @@
 Execution module - Handles code execution via OpenAI Responses API.
 """
 
+import io
 import os
+import atexit
 import json
+import time
 import base64
-import tempfile
-from typing import Dict, List, Tuple, Optional
+import random
+import hashlib
+import warnings
+import threading
+import traceback
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout, redirect_stderr
+from functools import lru_cache
+from typing import Callable, Dict, List, Tuple, Optional
+import httpx
 import pandas as pd
-from openai import OpenAI
+from openai import OpenAI, DefaultHttpxClient
 
-class CodeExecutor:
-    """Executes Python code using OpenAI's code interpreter."""
-    
-    def __init__(self, openai_api_key: str):
-        self.client = OpenAI(api_key=openai_api_key)
-    
-    def execute(self, code: str, df: pd.DataFrame) -> Tuple[str, List[bytes], Dict[str, pd.DataFrame], float]:
-        """
-        Execute analysis code in OpenAI sandbox using Assistants API.
+# Uploaded datasets kept for reuse before the least recently used is deleted
+FILE_CACHE_SIZE = 32
 
-        Args:
-            code: Python code to execute
-            df: DataFrame to analyze
-
-        Returns:
-            Tuple of (results_text, figures_list, tables_dict, cost)
-        """
-        figures = []
-        tables = {}
+# Upload encodings: format key -> (filename, MIME type)
+UPLOAD_FORMATS = {
+    'parquet': ("data.parquet", "application/vnd.apache.parquet"),
+    'csv': ("data.csv", "text/csv"),
+}
 
-        # Save dataframe to temp file for upload
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False) as f:
-            df.to_csv(f, index=False)
-            temp_csv_path = f.name
+# Analyses with code and data below these sizes run on the smaller model
+SMALL_CODE_CHARS = 2000
+SMALL_DATA_BYTES = 1_000_000
 
-        try:
-            # Upload the data file
-            with open(temp_csv_path, 'rb') as f:
-                file = self.client.files.create(file=f, purpose='assistants')
+# Streamed events that carry the run object itself (run steps have their own events)
+RUN_EVENTS = frozenset(
+    f"thread.run.{status}" for status in (
+        "created", "queued", "in_progress", "requires_action", "cancelling",
+        "cancelled", "failed", "completed", "incomplete", "expired"
+    )
+)
 
-            # Create assistant with code interpreter
-            assistant = self.client.beta.assistants.create(
-                name="Statistical Analyst",
-                instructions="You are a statistical analyst. Execute Python code to analyze data and generate results.",
-                model="gpt-4o",
-                tools=[{"type": "code_interpreter"}]
-            )
+# Result table files the sandbox may save, by extension
+TABLE_EXTENSIONS = ('.csv', '.parquet')
 
-            # Create the analysis prompt
-            analysis_prompt = f"""
-Execute the following Python code to analyze the uploaded CSV data.
+# Prompt for a full sandbox analysis; filled in with str.format per run
+ANALYSIS_PROMPT_TEMPLATE = """
+Execute the following Python code to analyze the uploaded data.
+{load_instruction}
 
 IMPORTANT INSTRUCTIONS:
 1. Load the data from the uploaded file using pandas
@@ -78,28 +78,320 @@ After running the analysis:
 Execute the code now and provide results.
 """
 
-            # Create thread
-            thread = self.client.beta.threads.create()
-
-            # Add message with file attachment
-            message = self.client.beta.threads.messages.create(
-                thread_id=thread.id,
-                role="user",
-                content=analysis_prompt,
-                attachments=[
-                    {
-                        "file_id": file.id,
-                        "tools": [{"type": "code_interpreter"}]
-                    }
-                ]
+# OpenAI clients shared by every executor using the same key, so their
+# connection pools stay warm across executors
+_CLIENTS: Dict[str, OpenAI] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def _get_client(api_key: str) -> OpenAI:
+    """Return the shared OpenAI client for an API key, creating it on first use."""
+    with _CLIENTS_LOCK:
+        if api_key not in _CLIENTS:
+            # HTTP/2 multiplexes the upload, polling and parallel downloads over one connection
+            _CLIENTS[api_key] = OpenAI(
+                api_key=api_key,
+                http_client=DefaultHttpxClient(
+                    http2=True,
+                    limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+                    timeout=httpx.Timeout(300.0)
+                )
             )
+        return _CLIENTS[api_key]
+
+
+# Live executors, cleaned up by a single exit hook without being kept alive by it
+_EXECUTORS = weakref.WeakSet()
 
-            # Run the assistant
-            run = self.client.beta.threads.runs.create_and_poll(
-                thread_id=thread.id,
-                assistant_id=assistant.id,
-                timeout=300  # 5 minutes timeout
+
+@atexit.register
+def _close_executors():
+    """Delete every live executor's assistants and uploads at interpreter exit."""
+    for executor in list(_EXECUTORS):
+        executor.close()
+
+
+class CodeExecutor:
+    """Executes Python code using OpenAI's code interpreter."""
+    
+    def __init__(self, openai_api_key: str):
+        self.client = _get_client(openai_api_key)
+        
+        # Assistants and uploads are reused across executions; close() deletes them,
+        # at the latest when the interpreter exits
+        self._assistant_ids = {}
+        self._file_ids = OrderedDict()  # dataframe fingerprint -> file id, least recent first
+        self._untracked_file_ids = []  # uploads of unhashable frames, never reused
+        self._file_formats = {}
+        self._lock = threading.Lock()
+        _EXECUTORS.add(self)
+    
+    def _get_assistant_id(self, name: str, instructions: str, model: str) -> str:
+        """Create the named code-interpreter assistant on first use per model and reuse it afterwards."""
+        with self._lock:
+            if (name, model) not in self._assistant_ids:
+                assistant = self.client.beta.assistants.create(
+                    name=name,
+                    instructions=instructions,
+                    model=model,
+                    tools=[{"type": "code_interpreter"}]
+                )
+                self._assistant_ids[(name, model)] = assistant.id
+            return self._assistant_ids[(name, model)]
+    
+    @staticmethod
+    def _choose_model(df: pd.DataFrame, code: str) -> str:
+        """Route small analyses to gpt-4o-mini, which returns sooner; everything else uses gpt-4o."""
+        if len(code) < SMALL_CODE_CHARS and df.memory_usage(index=False, deep=False).sum() < SMALL_DATA_BYTES:
+            return "gpt-4o-mini"
+        return "gpt-4o"
+    
+    def close(self):
+        """Delete the cached assistants and uploaded files concurrently. Failures are ignored."""
+        with self._lock:
+            deletions = (
+                [(self.client.beta.assistants.delete, assistant_id) for assistant_id in self._assistant_ids.values()] +
+                [(self.client.files.delete, file_id) for file_id in self._file_ids.values()] +
+                [(self.client.files.delete, file_id) for file_id in self._untracked_file_ids]
             )
+            self._assistant_ids.clear()
+            self._file_ids.clear()
+            self._untracked_file_ids.clear()
+            self._file_formats.clear()
+
+        def delete(delete_fn, resource_id):
+            try:
+                delete_fn(resource_id)
+            except Exception:
+                pass
+
+        # Plain threads rather than a ThreadPoolExecutor: close() also runs from the
+        # exit hook, after concurrent.futures has stopped accepting work. Where the
+        # interpreter refuses new threads too, the deletion runs inline instead
+        workers = []
+        for delete_fn, resource_id in deletions:
+            worker = threading.Thread(target=delete, args=(delete_fn, resource_id), daemon=True)
+            try:
+                worker.start()
+            except RuntimeError:
+                delete(delete_fn, resource_id)
+                continue
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+    
+    def _wait_for_run(self, thread_id: str, run_id: str, timeout: float):
+        """
+        Poll a run until it leaves the queued/in-progress states.
+        Starts at 250 ms and doubles up to 4 s with +/-20% jitter, so short runs
+        return quickly and long runs make few status calls.
+        """
+        delay = 0.25
+        deadline = time.monotonic() + timeout
+
+        while True:
+            run = self.client.beta.threads.runs.retrieve(run_id=run_id, thread_id=thread_id)
+            if run.status not in ('queued', 'in_progress', 'cancelling'):
+                return run
+            if time.monotonic() >= deadline:
+                return run
+
+            time.sleep(delay * random.uniform(0.8, 1.2))
+            delay = min(delay * 2, 4.0)
+
+    def _download_files(self, file_ids: List[str]) -> List[bytes]:
+        """
+        Download file contents concurrently, returned in the order of file_ids.
+        An image that appears in both the messages and the run steps is fetched once.
+        """
+        unique_ids = list(dict.fromkeys(file_ids))
+        if not unique_ids:
+            return []
+
+        def download(file_id):
+            return self.client.files.content(file_id).read()
+
+        with ThreadPoolExecutor(max_workers=min(8, len(unique_ids))) as pool:
+            contents = dict(zip(unique_ids, pool.map(download, unique_ids)))
+        return [contents[file_id] for file_id in file_ids]
+
+    def prestage_data(self, df: pd.DataFrame) -> str:
+        """
+        Upload the dataframe ahead of execution so it can overlap code generation.
+        Returns the uploaded file id; pass it to execute() via file_id.
+        """
+        # An unchanged dataframe reuses its earlier upload
+        try:
+            digest = hashlib.blake2b(pd.util.hash_pandas_object(df, index=False).values.tobytes(), digest_size=16)
+            digest.update(repr(tuple(df.columns)).encode('utf-8'))
+            fingerprint = digest.hexdigest()
+        except TypeError:
+            fingerprint = None  # unhashable cell values; always upload
+
+        with self._lock:
+            if fingerprint in self._file_ids:
+                self._file_ids.move_to_end(fingerprint)
+                return self._file_ids[fingerprint]
+
+        # Serialize straight into memory - no temp file written and read back
+        buffer, data_format = self._serialize(df)
+        filename, mime_type = UPLOAD_FORMATS[data_format]
+
+        file = self.client.files.create(file=(filename, buffer, mime_type), purpose='assistants')
+        evicted = None
+        with self._lock:
+            self._file_formats[file.id] = data_format
+            if fingerprint is None:
+                self._untracked_file_ids.append(file.id)
+            else:
+                self._file_ids[fingerprint] = file.id
+                if len(self._file_ids) > FILE_CACHE_SIZE:
+                    _, evicted = self._file_ids.popitem(last=False)
+
+        # Remove the least recently used upload without holding up this one
+        if evicted is not None:
+            threading.Thread(target=self._delete_file, args=(evicted,), daemon=True).start()
+        return file.id
+
+    def _delete_file(self, file_id: str):
+        """Delete an uploaded file. Failures are ignored."""
+        try:
+            self.client.files.delete(file_id)
+        except Exception:
+            pass
+        with self._lock:
+            self._file_formats.pop(file_id, None)
+
+    @staticmethod
+    def _serialize(df: pd.DataFrame) -> Tuple[io.BytesIO, str]:
+        """
+        Encode the dataframe for upload as zstd Parquet, several times smaller than CSV.
+        Frames Arrow cannot write (mixed-type or non-string column names) fall back to CSV.
+        Returns the buffer and its format key in UPLOAD_FORMATS.
+        """
+        # Categories are an in-app memory optimization; upload their plain values
+        # so the sandbox sees the same dtypes a CSV would give it
+        categorical = [col for col, dtype in df.dtypes.items() if isinstance(dtype, pd.CategoricalDtype)]
+        if categorical:
+            df = df.astype({col: df[col].cat.categories.dtype for col in categorical})
+
+        buffer = io.BytesIO()
+        try:
+            df.to_parquet(buffer, engine='pyarrow', compression='zstd', index=False)
+            data_format = 'parquet'
+        except (ImportError, ValueError, TypeError, NotImplementedError):
+            buffer = io.BytesIO()
+            df.to_csv(buffer, index=False)
+            data_format = 'csv'
+
+        buffer.seek(0)
+        return buffer, data_format
+
+    @staticmethod
+    def _read_table(data: bytes, ext: str) -> pd.DataFrame:
+        """Parse a downloaded result table; CSVs go through pyarrow's reader first."""
+        if ext == '.parquet':
+            return pd.read_parquet(io.BytesIO(data), engine='pyarrow')
+        try:
+            import pyarrow.csv as pacsv
+            return pacsv.read_csv(io.BytesIO(data)).to_pandas()
+        except ImportError:
+            return pd.read_csv(io.BytesIO(data))
+    
+    def _load_instruction(self, file_id: str) -> str:
+        """Tell the sandbox how to read the uploaded data file."""
+        data_format = self._file_formats.get(file_id, 'csv')
+        loader = 'pd.read_parquet' if data_format == 'parquet' else 'pd.read_csv'
+        return f"The uploaded data file is {data_format.upper()} ({UPLOAD_FORMATS[data_format][0]}); load it with {loader}."
+
+    def _run_thread(self, assistant_id: str, content: str, file_id: str, timeout: float,
+                    on_text: Optional[Callable[[str], None]] = None):
+        """
+        Create the thread, its message with the data attachment, and the run in a
+        single create_and_run request, then wait for the run to finish.
+        With on_text the run is streamed and assistant text deltas are passed to it.
+        Returns the final run; its thread_id identifies the thread.
+        """
+        thread = {
+            "messages": [{
+                "role": "user",
+                "content": content,
+                "attachments": [{"file_id": file_id, "tools": [{"type": "code_interpreter"}]}]
+            }]
+        }
+
+        if on_text is None:
+            run = self.client.beta.threads.create_and_run(assistant_id=assistant_id, thread=thread)
+            return self._wait_for_run(run.thread_id, run.id, timeout=timeout)
+
+        run = None
+        thread_id = None
+        stream = self.client.beta.threads.create_and_run(assistant_id=assistant_id, thread=thread, stream=True)
+
+        with stream:
+            for event in stream:
+                if event.event == 'thread.message.delta':
+                    for part in event.data.delta.content or []:
+                        if part.type == 'text' and part.text and part.text.value:
+                            on_text(part.text.value)
+                elif event.event in RUN_EVENTS:
+                    run = event.data
+                elif event.event == 'thread.created':
+                    thread_id = event.data.id
+
+        # A dropped stream may end before any run event; find the run from its thread
+        if run is None:
+            if thread_id is None:
+                raise RuntimeError("Run stream ended before the thread was created")
+            runs = self.client.beta.threads.runs.list(thread_id=thread_id, order="desc", limit=1)
+            if not runs.data:
+                raise RuntimeError(f"No run was started on thread {thread_id}")
+            run = runs.data[0]
+
+        # Fall back to polling if the stream ended before the run did
+        if run.status in ('queued', 'in_progress', 'cancelling'):
+            run = self._wait_for_run(run.thread_id, run.id, timeout=timeout)
+        return run
+
+    def execute(self, code: str, df: pd.DataFrame, file_id: Optional[str] = None,
+                on_text: Optional[Callable[[str], None]] = None,
+                model: Optional[str] = None) -> Tuple[str, List[bytes], Dict[str, pd.DataFrame], float]:
+        """
+        Execute analysis code in OpenAI sandbox using Assistants API.
+
+        Args:
+            code: Python code to execute
+            df: DataFrame to analyze
+            file_id: Id of data already uploaded with prestage_data(); uploaded here if None
+            on_text: If given, the run is streamed and each text delta is passed to it
+            model: Model to run on; chosen from the code and data size if None
+
+        Returns:
+            Tuple of (results_text, figures_list, tables_dict, cost)
+        """
+        figures = []
+        tables = {}
+
+        try:
+            # Upload the data file unless it was staged in advance
+            if file_id is None:
+                file_id = self.prestage_data(df)
+
+            # Code interpreter assistant, created once per executor and model
+            assistant_id = self._get_assistant_id(
+                name="Statistical Analyst",
+                instructions="You are a statistical analyst. Execute Python code to analyze data and generate results.",
+                model=model or self._choose_model(df, code)
+            )
+
+            # Create the analysis prompt
+            analysis_prompt = ANALYSIS_PROMPT_TEMPLATE.format(
+                load_instruction=self._load_instruction(file_id), code=code
+            )
+
+            # Create the thread with the data attached and run the assistant
+            run = self._run_thread(assistant_id, analysis_prompt, file_id,
+                                   timeout=300, on_text=on_text)  # 5 minutes timeout
 
             # Extract results
             results_text = ""
@@ -107,23 +399,30 @@ Execute the code now and provide results.
             if run.status == 'completed':
                 # Get messages
                 messages = self.client.beta.threads.messages.list(
-                    thread_id=thread.id,
+                    thread_id=run.thread_id,
                     order="asc"
                 )
 
+                # Collect file ids first and download them together afterwards
+                image_ids = []
+                table_files = {}
+
                 for msg in messages:
                     if msg.role == "assistant":
                         for content in msg.content:
                             if content.type == "text":
                                 results_text += content.text.value + "\n"
+                                # Tables saved in the sandbox are linked as file_path annotations
+                                for annotation in content.text.annotations:
+                                    if annotation.type == "file_path" and annotation.text.endswith(TABLE_EXTENSIONS):
+                                        name, ext = os.path.splitext(os.path.basename(annotation.text))
+                                        table_files[name.replace('_', ' ').title()] = (annotation.file_path.file_id, ext)
                             elif content.type == "image_file":
-                                # Download image file
-                                file_content = self.client.files.content(content.image_file.file_id)
-                                figures.append(file_content.read())
+                                image_ids.append(content.image_file.file_id)
 
                 # Check for generated files in run steps
                 run_steps = self.client.beta.threads.runs.steps.list(
-                    thread_id=thread.id,
+                    thread_id=run.thread_id,
                     run_id=run.id
                 )
 
@@ -134,9 +433,15 @@ Execute the code now and provide results.
                                 # Get output files from code interpreter
                                 for output in tool_call.code_interpreter.outputs:
                                     if output.type == "image":
-                                        file_content = self.client.files.content(output.image.file_id)
-                                        figures.append(file_content.read())
-                                    # Note: CSV files need to be explicitly saved and referenced
+                                        image_ids.append(output.image.file_id)
+
+                contents = self._download_files(image_ids + [fid for fid, _ in table_files.values()])
+                figures = contents[:len(image_ids)]
+                for (name, (_, ext)), data in zip(table_files.items(), contents[len(image_ids):]):
+                    try:
+                        tables[name] = self._read_table(data, ext)
+                    except (ValueError, UnicodeDecodeError):
+                        pass  # not a readable table; the text results still describe it
             else:
                 results_text = f"Run failed with status: {run.status}"
 
@@ -144,81 +449,60 @@ Execute the code now and provide results.
             # GPT-4o with code interpreter: ~$0.01-0.05 per execution typically
             cost = 0.03  # Rough estimate
 
-            # Clean up
-            self.client.files.delete(file.id)
-            self.client.beta.assistants.delete(assistant.id)
-
             return results_text, figures, tables, cost
 
         except Exception as e:
             error_msg = f"Execution error: {str(e)}\n{type(e).__name__}"
-            import traceback
             error_msg += f"\n{traceback.format_exc()}"
             return error_msg, [], {}, 0.0
-
-        finally:
-            # Clean up temp file
-            if os.path.exists(temp_csv_path):
-                os.remove(temp_csv_path)
     
-    def execute_simple(self, code: str, df: pd.DataFrame) -> Tuple[str, float]:
+    def execute_simple(self, code: str, df: pd.DataFrame,
+                       on_text: Optional[Callable[[str], None]] = None) -> Tuple[str, float]:
         """
         Simple execution for quick analysis mode - just returns text results.
+        If on_text is given, the run is streamed and each text delta is passed to it.
         """
-        # Save dataframe to temp file
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False) as f:
-            df.to_csv(f, index=False)
-            temp_csv_path = f.name
-
         try:
-            with open(temp_csv_path, 'rb') as f:
-                file = self.client.files.create(file=f, purpose='assistants')
+            file_id = self.prestage_data(df)
 
-            # Create assistant
-            assistant = self.client.beta.assistants.create(
-                name="Quick Analyst",
-                instructions="Execute Python code and return results.",
+            # A one-shot run needs no assistant, thread or message listing: the
+            # Responses API runs the code against the upload and replies in one request
+            request = dict(
                 model="gpt-4o-mini",
-                tools=[{"type": "code_interpreter"}]
-            )
-
-            # Create thread and run
-            thread = self.client.beta.threads.create()
-            message = self.client.beta.threads.messages.create(
-                thread_id=thread.id,
-                role="user",
-                content=f"Execute this code and return results:\n```python\n{code}\n```",
-                attachments=[{"file_id": file.id, "tools": [{"type": "code_interpreter"}]}]
-            )
-
-            run = self.client.beta.threads.runs.create_and_poll(
-                thread_id=thread.id,
-                assistant_id=assistant.id,
+                instructions="Execute Python code and return results.",
+                input=f"{self._load_instruction(file_id)}\nExecute this code and return results:\n```python\n{code}\n```",
+                tools=[{"type": "code_interpreter", "container": {"type": "auto", "file_ids": [file_id]}}],
                 timeout=120
             )
 
-            results_text = ""
-            if run.status == 'completed':
-                messages = self.client.beta.threads.messages.list(
-                    thread_id=thread.id,
-                    order="asc"
-                )
-                for msg in messages:
-                    if msg.role == "assistant":
-                        for content in msg.content:
-                            if content.type == "text":
-                                results_text += content.text.value + "\n"
-
-            self.client.files.delete(file.id)
-            self.client.beta.assistants.delete(assistant.id)
+            if on_text is None:
+                results_text = self.client.responses.create(**request).output_text
+            else:
+                parts = []
+                with self.client.responses.create(**request, stream=True) as stream:
+                    for event in stream:
+                        if event.type == 'response.output_text.delta':
+                            parts.append(event.delta)
+                            on_text(event.delta)
+                results_text = ''.join(parts)
 
             return results_text, 0.01
 
         except Exception as e:
             return f"Error: {str(e)}", 0.0
-        finally:
-            if os.path.exists(temp_csv_path):
-                os.remove(temp_csv_path)
+
+
+def _copy_on_write() -> bool:
+    """Whether pandas copies lazily on write (always on in pandas >= 3, opt-in on 2.x)."""
+    if int(pd.__version__.split('.')[0]) >= 3:
+        return True
+    return pd.options.mode.copy_on_write is True
+
+
+@lru_cache(maxsize=128)
+def _compile_analysis(code: str):
+    """Compile analysis source once; re-running the same code reuses the bytecode."""
+    return compile(code, '<analysis>', 'exec')
 
 
 class LocalExecutor:
@@ -228,16 +512,27 @@ class LocalExecutor:
     """
     
     def __init__(self):
-        pass
-    
-    def execute(self, code: str, df: pd.DataFrame) -> Tuple[str, List[bytes], Dict[str, pd.DataFrame], float]:
-        """Execute code locally using exec()."""
-        import io
-        import sys
-        from contextlib import redirect_stdout, redirect_stderr
+        # Import the analysis stack and select the headless backend once, not on
+        # every execute(); each run starts from a copy of this namespace
+        import numpy as np
+        import scipy.stats as stats
         import matplotlib
         matplotlib.use('Agg')
         import matplotlib.pyplot as plt
+        self.plt = plt
+        self._base_namespace = {
+            'pd': pd,
+            'np': np,
+            'stats': stats,
+            'scipy_stats': stats,
+            'plt': plt,
+            'warnings': warnings,
+            '__builtins__': __builtins__
+        }
+    
+    def execute(self, code: str, df: pd.DataFrame) -> Tuple[str, List[bytes], Dict[str, pd.DataFrame], float]:
+        """Execute code locally using exec()."""
+        plt = self.plt
         
         figures = []
         tables = {}
@@ -246,47 +541,52 @@ class LocalExecutor:
         stdout_capture = io.StringIO()
         stderr_capture = io.StringIO()
         
-        # Create execution namespace
+        # The caller's frame must not be modified. Under copy-on-write a shallow copy
+        # is enough; otherwise code can write through it (df.update, df.pop, .values
+        # and aliases included), so take a deep copy
+        data = df.copy(deep=not _copy_on_write())
+        
+        # Create execution namespace; code may call _register_table(name, df)
+        # to report tables explicitly
+        registered_tables = {}
         namespace = {
-            'pd': pd,
-            'df': df.copy(),
-            'plt': plt,
-            '__builtins__': __builtins__
+            **self._base_namespace,
+            'df': data,
+            '_register_table': registered_tables.__setitem__,
         }
         
         try:
-            # Add common imports to namespace
-            exec("""
-import numpy as np
-import scipy.stats as stats
-from scipy import stats as scipy_stats
-import warnings
-warnings.filterwarnings('ignore')
-""", namespace)
-            
-            with redirect_stdout(stdout_capture), redirect_stderr(stderr_capture):
-                exec(code, namespace)
+            # Silence library warnings for this run only, not process-wide
+            with warnings.catch_warnings(), redirect_stdout(stdout_capture), redirect_stderr(stderr_capture):
+                warnings.simplefilter('ignore')
+                exec(_compile_analysis(code), namespace)
             
             results_text = stdout_capture.getvalue()
+            # Anything the code wrote to stderr (e.g. fit diagnostics) is kept, not dropped
+            stderr_text = stderr_capture.getvalue()
+            if stderr_text:
+                results_text += f"\nSTDERR:\n{stderr_text}"
             
-            # Capture any matplotlib figures
-            fig_nums = plt.get_fignums()
-            for fig_num in fig_nums:
+            # Capture any matplotlib figures, reusing one buffer for every save
+            buf = io.BytesIO()
+            for fig_num in plt.get_fignums():
                 fig = plt.figure(fig_num)
-                buf = io.BytesIO()
-                fig.savefig(buf, format='png', dpi=150, bbox_inches='tight')
                 buf.seek(0)
-                figures.append(buf.read())
+                buf.truncate(0)
+                fig.savefig(buf, format='png', dpi=150, bbox_inches='tight')
+                figures.append(buf.getvalue())
                 plt.close(fig)
             
-            # Check for saved tables in namespace
-            for key, value in namespace.items():
-                if isinstance(value, pd.DataFrame) and key.startswith('table'):
-                    tables[key.replace('_', ' ').title()] = value
+            # Prefer registered tables; otherwise fall back to table* variables
+            if registered_tables:
+                tables.update(registered_tables)
+            else:
+                for key, value in namespace.items():
+                    if key.startswith('table') and isinstance(value, pd.DataFrame):
+                        tables[key.replace('_', ' ').title()] = value
             
             return results_text, figures, tables, 0.0
             
         except Exception as e:
-            import traceback
             error_msg = f"Execution error:\n{traceback.format_exc()}"
             return error_msg, [], {}, 0.0
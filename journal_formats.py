@@ -2,6 +2,9 @@
 Journal formats module - Contains formatting specifications for different journals.
 """
 
+from collections import namedtuple
+from types import MappingProxyType
+
 JOURNAL_FORMATS = {
     'Generic': {
         'name': 'Generic Medical Journal',
@@ -232,6 +235,85 @@ JOURNAL_FORMATS = {
     }
 }
 
+# Read-only view so the shared specs cannot be mutated at runtime
+JOURNAL_FORMATS = MappingProxyType(JOURNAL_FORMATS)
+
+# Journal names in display order, for selectors
+JOURNAL_KEYS = tuple(JOURNAL_FORMATS.keys())
+
+# Flattened view of the fields the formatting helpers read, so each use is one
+# attribute load instead of nested dict lookups. JOURNAL_FORMATS stays the source.
+JournalSpec = namedtuple('JournalSpec', [
+    'name', 'p_decimals', 'ci_decimals', 'mean_decimals', 'effect_decimals', 'pct_decimals',
+    'ci_format', 'sample_format', 'table1_format', 'software_citation'
+])
+
+_SPECS = MappingProxyType({
+    journal: JournalSpec(
+        name=fmt['name'],
+        p_decimals=fmt['decimal_places']['p_value'],
+        ci_decimals=fmt['decimal_places']['ci'],
+        mean_decimals=fmt['decimal_places']['mean'],
+        effect_decimals=fmt['decimal_places']['effect_size'],
+        pct_decimals=fmt['decimal_places']['percentage'],
+        ci_format=fmt['ci_format'],
+        sample_format=fmt['sample_format'],
+        table1_format=fmt.get('table1_format', JOURNAL_FORMATS['Generic']['table1_format']),
+        software_citation=fmt.get('statistical_software_citation', '')
+    )
+    for journal, fmt in JOURNAL_FORMATS.items()
+})
+
+
+def _spec(journal: str) -> JournalSpec:
+    """Look up a journal's spec, defaulting to Generic."""
+    return _SPECS.get(journal) or _SPECS['Generic']
+
+
+def _build_formatters(spec: JournalSpec) -> dict:
+    """
+    Specialize one journal's formatting rules into per-statistic callables.
+    Decimal places and templates are folded into format strings here, once,
+    so formatting a value is a single str.format call.
+    """
+    # Threshold and exact journals print P values the same way below .001
+    p_template = f'P = {{:.{spec.p_decimals}f}}'.format
+    ci_template = spec.ci_format.format(
+        lower=f'{{0:.{spec.ci_decimals}f}}', upper=f'{{1:.{spec.ci_decimals}f}}'
+    ).format
+    sample_template = spec.sample_format.format(
+        n='{0}', pct=f'{{1:.{spec.pct_decimals}f}}'
+    ).format
+    mean_sd_template = f'{{0:.{spec.mean_decimals}f}} ± {{1:.{spec.mean_decimals}f}}'.format
+    effect_template = f'{{:.{spec.effect_decimals}f}}'.format
+    
+    def p_value(p=0, **_):
+        return 'P < .001' if p < 0.001 else p_template(p)
+    
+    def ci(lower=0, upper=0, **_):
+        return ci_template(lower, upper)
+    
+    def sample(n=0, pct=0, **_):
+        return sample_template(n, pct)
+    
+    def mean_sd(mean=0, sd=0, **_):
+        return mean_sd_template(mean, sd)
+    
+    def effect_size(effect=0, **_):
+        return effect_template(effect)
+    
+    return {
+        'p_value': p_value,
+        'ci': ci,
+        'sample': sample,
+        'mean_sd': mean_sd,
+        'effect_size': effect_size,
+    }
+
+
+# Precomputed formatters: FORMATTERS[journal][stat_type](**values) -> str
+FORMATTERS = MappingProxyType({journal: _build_formatters(spec) for journal, spec in _SPECS.items()})
+
 
 def get_format_string(journal: str, stat_type: str, **kwargs) -> str:
     """
@@ -245,55 +327,51 @@ def get_format_string(journal: str, stat_type: str, **kwargs) -> str:
     Returns:
         Formatted string
     """
-    fmt = JOURNAL_FORMATS.get(journal, JOURNAL_FORMATS['Generic'])
+    formatter = FORMATTERS.get(journal, FORMATTERS['Generic']).get(stat_type)
+    if formatter is None:
+        return str(kwargs)
+    return formatter(**kwargs)
+
+
+def format_p_values(journal: str, p_values) -> "np.ndarray":
+    """
+    Vectorized get_format_string(journal, 'p_value') over an array of P values.
     
-    if stat_type == 'p_value':
-        p = kwargs.get('p', 0)
-        decimals = fmt['decimal_places']['p_value']
-        if fmt['p_value_format'] == 'threshold':
-            if p < 0.001:
-                return 'P < .001'
-            elif p < fmt['p_value_threshold']:
-                return f'P = {p:.{decimals}f}'
-            else:
-                return f'P = {p:.{decimals}f}'
-        else:
-            if p < 0.001:
-                return 'P < .001'
-            return f'P = {p:.{decimals}f}'
+    Returns:
+        Array of formatted strings with the same shape as p_values
+    """
+    # Imported here so the app's startup import of this module stays light
+    import numpy as np
     
-    elif stat_type == 'ci':
-        lower = kwargs.get('lower', 0)
-        upper = kwargs.get('upper', 0)
-        decimals = fmt['decimal_places']['ci']
-        template = fmt['ci_format']
-        return template.format(lower=f'{lower:.{decimals}f}', upper=f'{upper:.{decimals}f}')
+    p = np.asarray(p_values, dtype=float)
+    formatted = np.char.mod(f'P = %.{_spec(journal).p_decimals}f', p)
+    return np.where(p < 0.001, 'P < .001', formatted)
+
+
+def format_cis(journal: str, lower, upper) -> "np.ndarray":
+    """
+    Vectorized get_format_string(journal, 'ci') over arrays of interval bounds.
     
-    elif stat_type == 'sample':
-        n = kwargs.get('n', 0)
-        pct = kwargs.get('pct', 0)
-        decimals = fmt['decimal_places']['percentage']
-        template = fmt['sample_format']
-        return template.format(n=n, pct=f'{pct:.{decimals}f}')
+    Returns:
+        Array of formatted strings with the broadcast shape of lower and upper
+    """
+    import numpy as np
     
-    elif stat_type == 'mean_sd':
-        mean = kwargs.get('mean', 0)
-        sd = kwargs.get('sd', 0)
-        decimals = fmt['decimal_places']['mean']
-        return f'{mean:.{decimals}f} ± {sd:.{decimals}f}'
+    spec = _spec(journal)
+    number = f'%.{spec.ci_decimals}f'
     
-    elif stat_type == 'effect_size':
-        effect = kwargs.get('effect', 0)
-        decimals = fmt['decimal_places']['effect_size']
-        return f'{effect:.{decimals}f}'
+    # Split the template into the literal text around the two bounds
+    prefix, rest = spec.ci_format.split('{lower}', 1)
+    separator, suffix = rest.split('{upper}', 1)
     
-    return str(kwargs)
+    lower_text = np.char.mod(number, np.asarray(lower, dtype=float))
+    upper_text = np.char.mod(number, np.asarray(upper, dtype=float))
+    return np.char.add(np.char.add(np.char.add(prefix, lower_text), np.char.add(separator, upper_text)), suffix)
 
 
 def get_table1_format(journal: str) -> dict:
     """Get Table 1 formatting specifications for a journal."""
-    fmt = JOURNAL_FORMATS.get(journal, JOURNAL_FORMATS['Generic'])
-    return fmt.get('table1_format', JOURNAL_FORMATS['Generic']['table1_format'])
+    return _spec(journal).table1_format
 
 
 def get_software_citation(journal: str, packages: dict = None) -> str:
@@ -307,8 +385,7 @@ def get_software_citation(journal: str, packages: dict = None) -> str:
     Returns:
         Formatted citation string
     """
-    fmt = JOURNAL_FORMATS.get(journal, JOURNAL_FORMATS['Generic'])
-    base = fmt.get('statistical_software_citation', '')
+    base = _spec(journal).software_citation
     
     if packages:
         import sys
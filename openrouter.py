@@ -0,0 +1,80 @@
+"""
+OpenRouter module - HTTP helpers shared by the council and the results writer.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Tuple
+import httpx
+import orjson
+
+
+def run_async(work: Callable[[httpx.AsyncClient], Awaitable], headers: Dict[str, str],
+              timeout: float):
+    """
+    Run work(client) to completion from synchronous code.
+    Every request issued by work shares one HTTP/2 connection pool.
+    """
+    async def main():
+        async with httpx.AsyncClient(http2=True, timeout=timeout, headers=headers) as client:
+            return await work(client)
+
+    # asyncio.run refuses to nest inside a running loop (e.g. notebooks),
+    # so in that case drive the coroutine from a short-lived worker thread
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(main())
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, main()).result()
+
+
+class _StreamReader:
+    """Accumulates the text and usage of a chat completion's server-sent events."""
+
+    def __init__(self, on_delta: Callable[[str], None]):
+        self.on_delta = on_delta
+        self.parts: List[str] = []
+        self.usage: Dict = {}
+
+    def feed(self, line: str) -> bool:
+        """Handle one event-stream line; returns False once the stream is done."""
+        # Skip keep-alive comments and blank separators
+        if not line.startswith('data:'):
+            return True
+        data = line[5:].strip()
+        if data == '[DONE]':
+            return False
+
+        chunk = orjson.loads(data)
+        if chunk.get('usage'):
+            self.usage = chunk['usage']
+        for choice in chunk.get('choices', []):
+            delta = choice.get('delta', {}).get('content')
+            if delta:
+                self.parts.append(delta)
+                self.on_delta(delta)
+        return True
+
+    def result(self) -> Tuple[str, Dict]:
+        return ''.join(self.parts), self.usage
+
+
+def read_stream(response: httpx.Response, on_delta: Callable[[str], None]) -> Tuple[str, Dict]:
+    """Consume a streamed chat completion, passing each text delta to on_delta; returns (text, usage)."""
+    reader = _StreamReader(on_delta)
+    for line in response.iter_lines():
+        if not reader.feed(line):
+            break
+    return reader.result()
+
+
+async def read_stream_async(response: httpx.Response,
+                            on_delta: Callable[[str], None]) -> Tuple[str, Dict]:
+    """Async variant of read_stream."""
+    reader = _StreamReader(on_delta)
+    async for line in response.aiter_lines():
+        if not reader.feed(line):
+            break
+    return reader.result()
@@ -251,7 +251,7 @@ Generate complete Python code that:
    - Set publication-quality plot defaults
 
 2. DATA LOADING AND CLEANING
-   - Load data from 'data.csv'
+   - Load data from 'data.parquet' with pd.read_parquet if that file exists, otherwise from 'data.csv' with pd.read_csv (the upload format varies)
    - Apply documented cleaning steps
    - Create derived variables
 
@@ -388,14 +388,21 @@ Rules:
 - Follow the specified journal format precisely
 - Cite statistical software used""",
 
-    'methods_writing': """Write a Methods section for this analysis.
-
-ANALYSIS PLAN:
-{analysis_plan}
+    # Shared by every section request, after writing_system, so it can be prompt-cached
+    'writing_context': """STUDY CONTEXT (shared by all sections):
 
 STUDY DESIGN: {study_design}
 REPORTING GUIDELINE: {reporting_guideline}
 JOURNAL FORMAT: {journal_format}
+
+ANALYSIS PLAN:
+{analysis_plan}
+
+STATISTICAL OUTPUTS:
+{execution_results}""",
+
+    'methods_writing': """Write a Methods section for the analysis in the study context.
+
 SAMPLE SIZE: {sample_size}
 
 Write a complete Statistical Analysis subsection that includes:
@@ -411,19 +418,13 @@ Write a complete Statistical Analysis subsection that includes:
 
 Use journal-appropriate formatting. Be precise and complete.""",
 
-    'results_writing': """Write a Results section based on these outputs.
-
-STATISTICAL OUTPUTS:
-{execution_results}
+    'results_writing': """Write a Results section based on the statistical outputs in the study context.
 
 TABLES:
 {table_summaries}
 
 NUMBER OF FIGURES: {num_figures}
 
-JOURNAL FORMAT: {journal_format}
-REPORTING GUIDELINE: {reporting_guideline}
-
 Write complete Results text that:
 
 1. Opens with sample/cohort description
@@ -436,13 +437,7 @@ Write complete Results text that:
 
 Format statistics according to journal requirements. Include all relevant numbers.""",
 
-    'figure_legends': """Write figure legends for {num_figures} figures.
-
-ANALYSIS RESULTS:
-{execution_results}
-
-JOURNAL FORMAT:
-{journal_format}
+    'figure_legends': """Write figure legends for {num_figures} figures, based on the statistical outputs in the study context.
 
 For each figure, write a complete legend that:
 1. States what the figure shows
@@ -452,16 +447,11 @@ For each figure, write a complete legend that:
 
 Format: "Figure N. [Title]. [Description]..." """,
 
-    'limitations_writing': """Write a Limitations paragraph for this analysis.
-
-STUDY DESIGN: {study_design}
+    'limitations_writing': """Write a Limitations paragraph for the analysis in the study context.
 
 ADVERSARIAL REVIEW FINDINGS:
 {review}
 
-ANALYSIS APPROACH:
-{analysis_plan}
-
 Write a balanced Limitations paragraph that:
 1. Acknowledges key limitations honestly
 2. Addresses issues raised in review
@@ -470,5 +460,22 @@ Write a balanced Limitations paragraph that:
 5. Mentions potential unmeasured confounders
 6. Is appropriately self-critical without undermining findings
 
-Keep to one substantial paragraph (150-250 words)."""
+Keep to one substantial paragraph (150-250 words).""",
+
+    'combined_writing': """Write all four sections below in a single response.
+
+Return only a JSON object with exactly these string fields:
+{{"methods": "...", "results": "...", "legends": "...", "limitations": "..."}}
+
+METHODS TASK:
+{methods_task}
+
+RESULTS TASK:
+{results_task}
+
+FIGURE LEGENDS TASK:
+{legends_task}
+
+LIMITATIONS TASK:
+{limitations_task}"""
 }
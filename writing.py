@@ -3,64 +3,476 @@ Writing module - Generates methods and results sections using Claude Opus.
 """
 
 import os
+import re
 import json
+import time
+import asyncio
 import tempfile
-from typing import Dict, List, Tuple, Optional
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, Dict, List, Tuple, Optional
+import httpx
+import orjson
 import pandas as pd
-import requests
 from prompts import PROMPTS
 from journal_formats import JOURNAL_FORMATS
+from cache import ResponseCache
+from openrouter import read_stream, read_stream_async, run_async
+
+# Section keys requested from a combined writing call, in document order
+SECTION_KEYS = ('methods', 'results', 'legends', 'limitations')
+
+# Markdown heading prefix: '# ', '## ' or '### '
+_HEADING_RE = re.compile(r'(#{1,3}) ')
+
+# Reporting guideline for each study design; unknown designs fall back to STROBE
+REPORTING_GUIDELINES = {
+    'Retrospective Cohort': 'STROBE (Strengthening the Reporting of Observational Studies in Epidemiology)',
+    'Prospective Cohort': 'STROBE',
+    'Case-Control': 'STROBE',
+    'Cross-sectional': 'STROBE',
+    'RCT': 'CONSORT (Consolidated Standards of Reporting Trials)',
+    'Case Series': 'CARE (Case Report Guidelines)',
+    'Prediction Model': 'TRIPOD (Transparent Reporting of a Multivariable Prediction Model)',
+    'Auto-detect': 'STROBE'
+}
+
+# Rate limits and transient upstream failures are retried with exponential backoff
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+MAX_RETRIES = 3
+
+# Execution output beyond this many characters keeps only its start and end; the
+# summary statistics sit at the top and the final model output at the bottom
+MAX_RESULTS_CHARS = 50_000
+
+
+@lru_cache(maxsize=None)
+def _journal_format_json(journal: str) -> str:
+    """Indented JSON of a journal's format rules, rendered once per journal."""
+    return json.dumps(JOURNAL_FORMATS.get(journal, JOURNAL_FORMATS['Generic']), indent=2)
+
+
+class GenerationCancelled(Exception):
+    """Raised from an on_token callback to abort document generation."""
+
+
+class _OrderedSections:
+    """
+    Fans one on_token callback out to sections that are generated concurrently.
+    The earliest unfinished section streams live; later sections are buffered
+    and flushed in order as the sections before them finish.
+    """
+
+    def __init__(self, on_token: Callable[[str], None], count: int):
+        self._on_token = on_token
+        self._buffers = [[] for _ in range(count)]
+        self._finished = [False] * count
+        self._current = 0
+
+    def writer(self, index: int) -> Callable[[str], None]:
+        def write(token: str):
+            if index == self._current:
+                self._on_token(token)
+            else:
+                self._buffers[index].append(token)
+        return write
+
+    def finish(self, index: int):
+        self._finished[index] = True
+        while self._current < len(self._finished) and self._finished[self._current]:
+            self._current += 1
+            if self._current < len(self._buffers):
+                buffered, self._buffers[self._current] = self._buffers[self._current], []
+                for token in buffered:
+                    self._on_token(token)
+
+
+class _JsonSectionStream:
+    """
+    Incrementally decodes a streamed flat JSON object of string fields, forwarding
+    each known field's text to on_token under its heading as it arrives, so a
+    combined writing request can be shown live.
+    """
+
+    _ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f', '"': '"', '\\': '\\', '/': '/'}
+
+    def __init__(self, on_token: Callable[[str], None], headings: Dict[str, str]):
+        self._on_token = on_token
+        self._headings = headings
+        self._state = 'seek_key'
+        self._key = []
+        self._field = None
+        self._hex = []
+        self._high_surrogate = None
+
+    def feed(self, delta: str):
+        out = []
+        for char in delta:
+            state = self._state
+            if state == 'value':
+                if char == '\\':
+                    self._state = 'escape'
+                elif char == '"':
+                    self._state = 'seek_key'
+                elif self._field is not None:
+                    out.append(char)
+            elif state == 'escape':
+                if char == 'u':
+                    self._state = 'unicode'
+                    self._hex = []
+                else:
+                    self._state = 'value'
+                    if self._field is not None:
+                        out.append(self._ESCAPES.get(char, char))
+            elif state == 'unicode':
+                self._hex.append(char)
+                if len(self._hex) == 4:
+                    self._state = 'value'
+                    code = int(''.join(self._hex), 16)
+                    if 0xD800 <= code < 0xDC00:
+                        self._high_surrogate = code
+                        continue
+                    if self._high_surrogate is not None and 0xDC00 <= code < 0xE000:
+                        code = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+                    self._high_surrogate = None
+                    if self._field is not None:
+                        out.append(chr(code))
+            elif state == 'seek_key':
+                if char == '"':
+                    self._state = 'key'
+                    self._key = []
+            elif state == 'key':
+                if char == '"':
+                    self._state = 'seek_value'
+                else:
+                    self._key.append(char)
+            elif state == 'seek_value' and char == '"':
+                self._state = 'value'
+                heading = self._headings.get(''.join(self._key))
+                self._field = heading
+                if heading is not None:
+                    if out:
+                        self._on_token(''.join(out))
+                        out = []
+                    self._on_token(f"\n\n## {heading}\n\n")
+        if out:
+            self._on_token(''.join(out))
+
 
 class ResultsWriter:
     """Generates publication-ready methods and results sections."""
     
-    def __init__(self, openrouter_api_key: str):
+    def __init__(self, openrouter_api_key: str, use_cache: bool = True):
         self.api_key = openrouter_api_key
         self.base_url = "https://openrouter.ai/api/v1/chat/completions"
         self.model_id = "anthropic/claude-opus-4-5"
         self.input_cost = 5.00  # per 1M tokens
         self.output_cost = 25.00  # per 1M tokens
-    
-    def _call_opus(self, messages: List[Dict], temperature: float = 0.3) -> Tuple[str, float]:
-        """Call Claude Opus via OpenRouter."""
-        headers = {
+        # Refuse to start a document whose worst-case cost exceeds this many dollars
+        self.cost_ceiling = float(os.environ.get("STATS_COUNCIL_COST_CEILING", "5.0"))
+        # Drafts are written at temperature 0.2 or below; rerunning with identical
+        # inputs reuses the previous draft rather than paying for a new one
+        self.cache = ResponseCache(enabled=use_cache, max_temperature=0.2)
+        
+        self._headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
             "HTTP-Referer": "https://stats-council.streamlit.app",
             "X-Title": "Stats Council"
         }
         
+        # One keep-alive HTTP/2 client so synchronous calls share a TLS connection
+        self._client = httpx.Client(
+            http2=True,
+            headers=self._headers,
+            timeout=180,
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=8)
+        )
+    
+    def close(self):
+        """Close the pooled HTTP connections."""
+        self._client.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def _build_payload(self, messages: List[Dict], temperature: float, stream: bool,
+                       max_tokens: int = 8192) -> Dict:
+        """Build the OpenRouter request body, asking for usage in the final chunk when streaming."""
         payload = {
             "model": self.model_id,
             "messages": messages,
             "temperature": temperature,
-            "max_tokens": 8192
+            "max_tokens": max_tokens
         }
+        if stream:
+            payload["stream"] = True
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+    
+    def _cost(self, usage: Dict) -> float:
+        """
+        Price a response from its token usage.
+        Prompt-cache reads bill at 0.1x and writes at 1.25x the input price; OpenRouter
+        counts both inside prompt_tokens and breaks them out in prompt_tokens_details.
+        """
+        details = usage.get('prompt_tokens_details') or {}
+        cache_read = usage.get('cache_read_input_tokens', details.get('cached_tokens', 0)) or 0
+        cache_write = usage.get('cache_creation_input_tokens', details.get('cache_write_tokens', 0)) or 0
+        input_tokens = max(usage.get('prompt_tokens', 0) - cache_read - cache_write, 0)
+        output_tokens = usage.get('completion_tokens', 0)
         
+        input_cost = (input_tokens + 0.1 * cache_read + 1.25 * cache_write) * self.input_cost
+        return (input_cost + output_tokens * self.output_cost) / 1_000_000
+    
+    def _cache_lookup(self, messages: List[Dict], temperature: float, use_cache: bool,
+                      on_token: Optional[Callable[[str], None]]) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Return (cache_key, cached_content) for a request. The key is None when the
+        request may not be cached; a hit is passed to on_token as a single delta.
+        """
+        if not (use_cache and self.cache.accepts(temperature)):
+            return None, None
+        cache_key = self.cache.make_key(self.model_id, messages, temperature)
+        cached = self.cache.get(cache_key)
+        if cached is not None and on_token is not None:
+            on_token(cached[0])
+        return cache_key, cached[0] if cached is not None else None
+    
+    @staticmethod
+    def _retry_delay(response: httpx.Response, attempt: int) -> Optional[float]:
+        """
+        Seconds to wait before retrying a response, or None if it should not be retried.
+        Honors a numeric Retry-After (capped at 30 s), else backs off 0.5 s, 1 s, 2 s.
+        """
+        if response.status_code not in RETRY_STATUSES or attempt >= MAX_RETRIES:
+            return None
         try:
-            response = requests.post(self.base_url, headers=headers, json=payload, timeout=180)
-            response.raise_for_status()
-            result = response.json()
-            
-            content = result['choices'][0]['message']['content']
-            
-            # Calculate cost
-            usage = result.get('usage', {})
-            input_tokens = usage.get('prompt_tokens', 0)
-            output_tokens = usage.get('completion_tokens', 0)
-            cost = (input_tokens * self.input_cost / 1_000_000) + (output_tokens * self.output_cost / 1_000_000)
+            return min(float(response.headers['retry-after']), 30.0)
+        except (KeyError, ValueError):
+            return 0.5 * 2 ** attempt
+    
+    @staticmethod
+    def _message_content(response: httpx.Response) -> Tuple[str, Dict]:
+        """Text and usage of a non-streamed completion."""
+        result = orjson.loads(response.content)
+        return result['choices'][0]['message']['content'], result.get('usage', {})
+    
+    def _send(self, body: bytes, on_token: Optional[Callable[[str], None]] = None,
+              timeout: float = 180) -> Tuple[str, Dict]:
+        """
+        POST a request body and return (content, usage), streaming into on_token if given.
+        Retryable statuses are retried before any of the reply is read.
+        """
+        attempt = 0
+        while True:
+            if on_token is not None:
+                # The context manager returns the connection to the pool even when a stream is cut short
+                with self._client.stream("POST", self.base_url, content=body, timeout=timeout) as response:
+                    delay = self._retry_delay(response, attempt)
+                    if delay is None:
+                        response.raise_for_status()
+                        return read_stream(response, on_token)
+            else:
+                response = self._client.post(self.base_url, content=body, timeout=timeout)
+                delay = self._retry_delay(response, attempt)
+                if delay is None:
+                    response.raise_for_status()
+                    return self._message_content(response)
+            time.sleep(delay)
+            attempt += 1
+    
+    async def _send_async(self, client: httpx.AsyncClient, body: bytes,
+                          on_token: Optional[Callable[[str], None]] = None) -> Tuple[str, Dict]:
+        """Async variant of _send."""
+        attempt = 0
+        while True:
+            if on_token is not None:
+                async with client.stream("POST", self.base_url, content=body) as response:
+                    delay = self._retry_delay(response, attempt)
+                    if delay is None:
+                        response.raise_for_status()
+                        return await read_stream_async(response, on_token)
+            else:
+                response = await client.post(self.base_url, content=body)
+                delay = self._retry_delay(response, attempt)
+                if delay is None:
+                    response.raise_for_status()
+                    return self._message_content(response)
+            await asyncio.sleep(delay)
+            attempt += 1
+    
+    def _call_opus(self, messages: List[Dict], temperature: float = 0.0,
+                   on_token: Optional[Callable[[str], None]] = None,
+                   use_cache: bool = True, max_tokens: int = 8192) -> Tuple[str, float]:
+        """
+        Call Claude Opus via OpenRouter.
+        When on_token is given the response is streamed and each text delta is passed to it.
+        Identical requests are answered from the response cache unless use_cache is False.
+        """
+        cache_key, cached = self._cache_lookup(messages, temperature, use_cache, on_token)
+        if cached is not None:
+            return cached, 0.0
+        
+        payload = self._build_payload(messages, temperature, stream=on_token is not None,
+                                      max_tokens=max_tokens)
+        body = orjson.dumps(payload)
+        
+        try:
+            content, usage = self._send(body, on_token)
+            cost = self._cost(usage)
+            if cache_key is not None:
+                self.cache.set(cache_key, content, cost)
+            return content, cost
             
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            return f"Error: {str(e)}", 0.0
+    
+    async def _call_opus_async(self, client: httpx.AsyncClient, messages: List[Dict],
+                               temperature: float = 0.0,
+                               on_token: Optional[Callable[[str], None]] = None,
+                               use_cache: bool = True, max_tokens: int = 8192) -> Tuple[str, float]:
+        """Async variant of _call_opus so independent sections can be written concurrently."""
+        cache_key, cached = self._cache_lookup(messages, temperature, use_cache, on_token)
+        if cached is not None:
+            return cached, 0.0
+        
+        payload = self._build_payload(messages, temperature, stream=on_token is not None,
+                                      max_tokens=max_tokens)
+        body = orjson.dumps(payload)
+        
+        try:
+            content, usage = await self._send_async(client, body, on_token)
+            cost = self._cost(usage)
+            if cache_key is not None:
+                self.cache.set(cache_key, content, cost)
             return content, cost
             
+        except GenerationCancelled:
+            raise
         except Exception as e:
             return f"Error: {str(e)}", 0.0
     
+    def _write_sections(self, sections: List[Tuple[str, List[Dict], int, float]],
+                        on_token: Optional[Callable[[str], None]] = None) -> List[Tuple[str, float]]:
+        """
+        Generate independent (heading, messages, max_tokens, temperature) sections concurrently. The first request
+        is always streamed and the rest start once it begins responding, so they can read
+        the prompt-cached prefix it writes. With on_token, each heading and its text are
+        streamed in section order. Results keep the input order.
+        """
+        async def write_all(client):
+            streams = _OrderedSections(on_token, len(sections)) if on_token is not None else None
+            # A prompt-cache entry is only readable once the request that writes it has
+            # started responding, so the other sections wait for the first one's first token
+            cache_warm = asyncio.Event()
+            
+            async def write(index, heading, messages, max_tokens, temperature):
+                section_token = None
+                if streams is not None:
+                    section_token = streams.writer(index)
+                    section_token(f"\n\n## {heading}\n\n")
+                
+                if index == 0:
+                    def first_token(token, forward=section_token):
+                        cache_warm.set()
+                        if forward is not None:
+                            forward(token)
+                    section_token = first_token
+                else:
+                    await cache_warm.wait()
+                
+                try:
+                    return await self._call_opus_async(client, messages, temperature=temperature,
+                                                       on_token=section_token, max_tokens=max_tokens)
+                finally:
+                    if index == 0:
+                        cache_warm.set()
+                    if streams is not None:
+                        streams.finish(index)
+            
+            return await asyncio.gather(*[
+                write(index, *section) for index, section in enumerate(sections)
+            ])
+        
+        return run_async(write_all, self._headers, timeout=180)
+    
+    def _write_combined(self, system_message: Dict, prompts: List[str],
+                        on_token: Optional[Callable[[str], None]] = None,
+                        headings: Optional[Dict[str, str]] = None,
+                        max_tokens: int = 16384,
+                        temperature: float = 0.2) -> Tuple[Optional[List[str]], float]:
+        """
+        Write all sections with one JSON-mode request instead of one request each.
+        With on_token the reply is streamed and each section's text is forwarded under
+        its entry in headings (keyed by SECTION_KEYS) as it is decoded.
+        Returns the section texts in SECTION_KEYS order, or None if the reply did not
+        parse into every section, together with the cost of the request.
+        """
+        prompt = PROMPTS['combined_writing'].format(
+            **{f"{key}_task": task for key, task in zip(SECTION_KEYS, prompts)}
+        )
+        messages = [system_message, {"role": "user", "content": prompt}]
+        decoder = _JsonSectionStream(on_token, headings or {}) if on_token is not None else None
+        
+        cache_key, content = self._cache_lookup(
+            messages, temperature, True, decoder.feed if decoder is not None else None
+        )
+        if content is not None:
+            return self._parse_combined(content), 0.0
+        
+        payload = self._build_payload(messages, temperature, stream=on_token is not None,
+                                      max_tokens=max_tokens)
+        payload["response_format"] = {"type": "json_object"}
+        body = orjson.dumps(payload)
+        
+        try:
+            content, usage = self._send(body, decoder.feed if decoder is not None else None, timeout=300)
+        except GenerationCancelled:
+            raise
+        except Exception:
+            return None, 0.0
+        
+        cost = self._cost(usage)
+        texts = self._parse_combined(content)
+        if texts is not None and cache_key is not None:
+            self.cache.set(cache_key, content, cost)
+        return texts, cost
+    
+    @staticmethod
+    def _parse_combined(content: str) -> Optional[List[str]]:
+        """Split a combined JSON reply into section texts, or None if any section is missing."""
+        content = content.strip()
+        # Tolerate a fenced reply even in JSON mode
+        if content.startswith('```'):
+            content = content.partition('\n')[2].rpartition('```')[0]
+        try:
+            sections = json.loads(content)
+            texts = [sections[key] for key in SECTION_KEYS]
+        except (ValueError, KeyError, TypeError):
+            return None
+        if not all(isinstance(text, str) for text in texts):
+            return None
+        return texts
+    
     def generate_results_document(self, df: pd.DataFrame, analysis_plan: str,
                                   execution_results: str, figures: List[bytes],
                                   tables: Dict[str, pd.DataFrame], review: str,
-                                  journal: str, study_design: str) -> Tuple[str, float]:
+                                  journal: str, study_design: str,
+                                  on_token: Optional[Callable[[str], None]] = None,
+                                  combine: bool = False) -> Tuple[str, float]:
         """
         Generate complete methods and results sections.
+        If on_token is given, section headings and generated text are streamed to it.
+        With combine, all sections come from one JSON-mode request, falling back to
+        separate requests if its reply cannot be parsed.
         
         Returns:
             Tuple of (document_path, cost)
@@ -71,105 +483,146 @@ class ResultsWriter:
         # Determine reporting guideline
         reporting_guideline = self._get_reporting_guideline(study_design)
         
-        # Prepare table summaries for context
-        table_summaries = {}
-        for name, table in tables.items():
-            table_summaries[name] = table.to_string()[:2000]  # Limit for context
+        if len(execution_results) > MAX_RESULTS_CHARS:
+            half = MAX_RESULTS_CHARS // 2
+            execution_results = (
+                f"{execution_results[:half]}\n...[truncated]...\n{execution_results[-half:]}"
+            )
         
-        # Generate methods section
-        methods_prompt = PROMPTS['methods_writing'].format(
-            analysis_plan=analysis_plan,
-            study_design=study_design,
-            reporting_guideline=reporting_guideline,
-            journal_format=json.dumps(journal_format, indent=2),
-            sample_size=len(df)
-        )
+        # Prepare table summaries for context, as plain text: JSON-encoding the rendered
+        # tables escaped every newline and quote, costing tokens and hurting readability
+        table_summaries = "\n\n".join(
+            f"{name}:\n{self._summarize_table(table)}" for name, table in tables.items()
+        ) or "(none)"
         
-        messages = [
-            {"role": "system", "content": PROMPTS['writing_system']},
-            {"role": "user", "content": methods_prompt}
-        ]
+        # Everything the sections share goes in one system prefix that is sent first
+        # and marked for prompt caching; each request then adds only its own inputs
+        system_message = {"role": "system", "content": [
+            {"type": "text", "text": PROMPTS['writing_system']},
+            {
+                "type": "text",
+                "text": PROMPTS['writing_context'].format(
+                    study_design=study_design,
+                    reporting_guideline=reporting_guideline,
+                    journal_format=_journal_format_json(journal),
+                    analysis_plan=analysis_plan,
+                    execution_results=execution_results
+                ),
+                "cache_control": {"type": "ephemeral"}
+            }
+        ]}
         
-        methods_text, methods_cost = self._call_opus(messages)
+        # Per-section instructions; each depends only on the inputs, so sections are independent
+        methods_prompt = PROMPTS['methods_writing'].format(sample_size=len(df))
         
-        # Generate results section
         results_prompt = PROMPTS['results_writing'].format(
-            execution_results=execution_results,
-            table_summaries=json.dumps(table_summaries, indent=2),
-            num_figures=len(figures),
-            journal_format=json.dumps(journal_format, indent=2),
-            reporting_guideline=reporting_guideline
+            table_summaries=table_summaries,
+            num_figures=len(figures)
         )
         
-        messages = [
-            {"role": "system", "content": PROMPTS['writing_system']},
-            {"role": "user", "content": results_prompt}
-        ]
+        legends_prompt = PROMPTS['figure_legends'].format(num_figures=len(figures))
         
-        results_text, results_cost = self._call_opus(messages)
+        limitations_prompt = PROMPTS['limitations_writing'].format(review=review)
         
-        # Generate figure legends
-        legends_prompt = PROMPTS['figure_legends'].format(
-            num_figures=len(figures),
-            execution_results=execution_results[:3000],
-            journal_format=json.dumps(journal_format, indent=2)
-        )
-        
-        messages = [
-            {"role": "system", "content": PROMPTS['writing_system']},
-            {"role": "user", "content": legends_prompt}
-        ]
+        headings = ("Methods", "Results", "Figure Legends", "Limitations")
+        prompts = [methods_prompt, results_prompt, legends_prompt, limitations_prompt]
         
-        legends_text, legends_cost = self._call_opus(messages)
-        
-        # Generate limitations paragraph
-        limitations_prompt = PROMPTS['limitations_writing'].format(
-            study_design=study_design,
-            review=review,
-            analysis_plan=analysis_plan
-        )
+        # Output is billed at 5x the input rate, so cap each section near its expected
+        # length: a legend runs ~100 tokens per figure, and limitations_writing asks
+        # for one 150-250 word paragraph
+        token_limits = [4096, 6144, max(256, min(2048, 256 * len(figures))), 768]
+        # Methods and limitations follow rigid templates, so they are written greedily;
+        # results and legends keep a little variation in phrasing
+        temperatures = [0.0, 0.2, 0.2, 0.0]
         
-        messages = [
-            {"role": "system", "content": PROMPTS['writing_system']},
-            {"role": "user", "content": limitations_prompt}
-        ]
+        estimated_cost = self._estimate_cost(system_message, prompts, token_limits)
+        if estimated_cost > self.cost_ceiling:
+            raise ValueError(
+                f"Estimated cost ${estimated_cost:.2f} exceeds the ${self.cost_ceiling:.2f} ceiling; "
+                "shorten the analysis output or raise STATS_COUNCIL_COST_CEILING"
+            )
         
-        limitations_text, limitations_cost = self._call_opus(messages)
+        # The tables section does not depend on the generated text, so build it on a
+        # worker thread while the requests are in flight instead of after they finish
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            tables_future = pool.submit(self._build_tables_section, tables) if tables else None
+            
+            texts = None
+            total_cost = 0.0
+            if combine:
+                texts, total_cost = self._write_combined(
+                    system_message, prompts, on_token=on_token, headings=dict(zip(SECTION_KEYS, headings)),
+                    max_tokens=sum(token_limits), temperature=max(temperatures)
+                )
+            
+            if texts is None:
+                sections = [
+                    (heading, [system_message, {"role": "user", "content": prompt}], max_tokens, temperature)
+                    for heading, prompt, max_tokens, temperature in zip(headings, prompts, token_limits, temperatures)
+                ]
+                results = self._write_sections(sections, on_token=on_token)
+                texts = [text for text, _ in results]
+                total_cost += sum(cost for _, cost in results)
+            
+            try:
+                table_elements = tables_future.result() if tables_future else []
+            except Exception:
+                table_elements = None  # rebuilt (or reported) by _create_word_document
         
-        total_cost = methods_cost + results_cost + legends_cost + limitations_cost
+        methods_text, results_text, legends_text, limitations_text = texts
         
         # Create Word document
         doc_path = self._create_word_document(
             methods_text, results_text, legends_text, limitations_text,
-            tables, journal_format
+            tables, journal_format, table_elements=table_elements
         )
         
         return doc_path, total_cost
     
+    def _estimate_cost(self, system_message: Dict, prompts: List[str],
+                       token_limits: List[int]) -> float:
+        """
+        Worst-case cost of writing every section: ~4 characters per input token, no
+        prompt-cache discount, and each section using its full max_tokens.
+        """
+        prefix_chars = sum(len(block['text']) for block in system_message['content'])
+        input_tokens = sum(prefix_chars + len(prompt) for prompt in prompts) // 4
+        return (input_tokens * self.input_cost + sum(token_limits) * self.output_cost) / 1_000_000
+    
+    @staticmethod
+    def _summarize_table(table: pd.DataFrame, max_chars: int = 2000) -> str:
+        """
+        Render the start of a table for a prompt, noting when rows were left out.
+        A rendered row takes at least 4 characters, so the first max_chars / 4 rows
+        fill the budget without formatting the whole table.
+        """
+        rendered = table.head(max_chars // 4).to_string()
+        if len(rendered) <= max_chars:
+            return rendered
+        # Cut at a row boundary so the model never sees a half row
+        shown = rendered[:max_chars].rpartition('\n')[0] or rendered[:max_chars]
+        rows_shown = shown.count('\n')  # excludes the header line
+        return f"{shown}\n... (first {rows_shown} of {len(table)} rows shown)"
+    
     def _get_reporting_guideline(self, study_design: str) -> str:
         """Get appropriate reporting guideline for study design."""
-        guidelines = {
-            'Retrospective Cohort': 'STROBE (Strengthening the Reporting of Observational Studies in Epidemiology)',
-            'Prospective Cohort': 'STROBE',
-            'Case-Control': 'STROBE',
-            'Cross-sectional': 'STROBE',
-            'RCT': 'CONSORT (Consolidated Standards of Reporting Trials)',
-            'Case Series': 'CARE (Case Report Guidelines)',
-            'Prediction Model': 'TRIPOD (Transparent Reporting of a Multivariable Prediction Model)',
-            'Auto-detect': 'STROBE'
-        }
-        return guidelines.get(study_design, 'STROBE')
+        return REPORTING_GUIDELINES.get(study_design, 'STROBE')
     
     def _create_word_document(self, methods: str, results: str, legends: str,
                              limitations: str, tables: Dict[str, pd.DataFrame],
-                             journal_format: dict) -> str:
-        """Create Word document using python-docx library."""
+                             journal_format: dict, table_elements: Optional[List] = None) -> str:
+        """
+        Create Word document using python-docx library.
+        table_elements, from _build_tables_section, saves rebuilding the tables here.
+        """
+        # Deferred so importing the writer (and starting the app) does not pay for
+        # python-docx until a document is actually built; later calls hit sys.modules
         from docx import Document
-        from docx.shared import Pt, Inches
+        from docx.shared import Pt
         from docx.enum.text import WD_ALIGN_PARAGRAPH
 
-        # Output path
-        output_path = tempfile.mktemp(suffix='.docx')
+        # Output path, created atomically so no other process can claim the name first
+        output_path = self._temp_path('.docx')
 
         try:
             # Create document
@@ -194,13 +647,11 @@ class ResultsWriter:
             self._add_formatted_text(doc, results)
 
             # Add tables if any
-            if tables:
-                doc.add_page_break()
-                doc.add_heading('Tables', level=1)
-                for table_name, table_df in tables.items():
-                    doc.add_heading(table_name, level=2)
-                    self._add_dataframe_table(doc, table_df)
-                    doc.add_paragraph()
+            if table_elements is None:
+                table_elements = self._build_tables_section(tables)
+            body = doc.element.body
+            for element in table_elements:
+                body.insert_element_before(element, 'w:sectPr')
 
             # Figure legends
             doc.add_heading('Figure Legends', level=1)
@@ -216,22 +667,62 @@ class ResultsWriter:
 
         except Exception as e:
             # Fallback: create simple text file
-            fallback_path = tempfile.mktemp(suffix='.txt')
-            with open(fallback_path, 'w') as f:
-                f.write("METHODS\n\n")
-                f.write(methods)
-                f.write("\n\nRESULTS\n\n")
-                f.write(results)
-                f.write("\n\nFIGURE LEGENDS\n\n")
-                f.write(legends)
-                f.write("\n\nLIMITATIONS\n\n")
-                f.write(limitations)
+            try:
+                os.remove(output_path)
+            except OSError:
+                pass
+            # Write through the descriptor mkstemp already opened, in a single write
+            fd, fallback_path = tempfile.mkstemp(suffix='.txt')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(''.join([
+                    "METHODS\n\n", methods,
+                    "\n\nRESULTS\n\n", results,
+                    "\n\nFIGURE LEGENDS\n\n", legends,
+                    "\n\nLIMITATIONS\n\n", limitations
+                ]))
 
             return fallback_path
 
+    def _build_tables_section(self, tables: Dict[str, pd.DataFrame]) -> List:
+        """
+        Build the Tables section in a scratch document and return its body elements.
+        Every Document starts from the same default template, so the style ids the
+        elements reference resolve the same once moved into the report.
+        """
+        # Empty frames (no rows or no columns) would add a heading over a bare header row
+        tables = {
+            name: table_df for name, table_df in tables.items()
+            if table_df is not None and not table_df.empty
+        }
+        if not tables:
+            return []
+        
+        from docx import Document
+        
+        scratch = Document()
+        scratch.add_page_break()
+        scratch.add_heading('Tables', level=1)
+        for table_name, table_df in tables.items():
+            scratch.add_heading(table_name, level=2)
+            self._add_dataframe_table(scratch, table_df)
+            scratch.add_paragraph()
+        
+        body = scratch.element.body
+        return [element for element in body if element is not body.sectPr]
+
+    @staticmethod
+    def _temp_path(suffix: str) -> str:
+        """Create an empty temporary file and return its path, for writers that need a path."""
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        os.close(fd)
+        return path
+
     def _add_formatted_text(self, doc, text: str):
         """Add formatted text to document, handling markdown-style formatting."""
         lines = text.split('\n')
+        # add_heading looks its style up by name on every call, which dominated this
+        # loop; resolve each heading level's style once and pass the object instead
+        heading_styles = {}
 
         for line in lines:
             line = line.strip()
@@ -239,12 +730,14 @@ class ResultsWriter:
                 continue
 
             # Check for headers
-            if line.startswith('### '):
-                doc.add_heading(line[4:], level=3)
-            elif line.startswith('## '):
-                doc.add_heading(line[3:], level=2)
-            elif line.startswith('# '):
-                doc.add_heading(line[2:], level=1)
+            heading = _HEADING_RE.match(line)
+            if heading:
+                level = len(heading.group(1))
+                if level not in heading_styles:
+                    heading_styles[level] = doc.styles[f'Heading {level}']
+                doc.add_paragraph(line[heading.end():], heading_styles[level])
+            elif '**' not in line:
+                doc.add_paragraph(line)
             else:
                 # Regular paragraph - handle bold text marked with **
                 p = doc.add_paragraph()
@@ -257,17 +750,68 @@ class ResultsWriter:
 
     def _add_dataframe_table(self, doc, df: pd.DataFrame):
         """Add a pandas DataFrame as a table to the document."""
-        # Create table with header row
-        table = doc.add_table(rows=1, cols=len(df.columns))
+        if df.empty:
+            return
+
+        from docx.oxml.ns import qn
+        from lxml.etree import SubElement
+
+        # Create the table at full size instead of growing it row by row
+        table = doc.add_table(rows=len(df) + 1, cols=len(df.columns))
         table.style = 'Light Grid Accent 1'
 
-        # Add header row
-        header_cells = table.rows[0].cells
-        for i, col_name in enumerate(df.columns):
-            header_cells[i].text = str(col_name)
+        # Write each value as a run straight into the cell XML. The Cell.text setter
+        # clears and rebuilds the cell through python-docx wrappers, which dominated
+        # the time on tables of a few hundred rows. itertuples yields plain tuples
+        # rather than a Series per row
+        run_tag, text_tag, space_attr = qn('w:r'), qn('w:t'), qn('xml:space')
+        rows = itertools.chain([tuple(df.columns)], df.itertuples(index=False, name=None))
+        for tr, values in zip(table._tbl.tr_lst, rows):
+            for tc, value in zip(tr.tc_lst, values):
+                text = str(value)
+                paragraph = tc.p_lst[0]
+                if '\t' in text or '\n' in text or '\r' in text:
+                    # Tabs and line breaks need their own elements; let python-docx build them
+                    paragraph.add_r().text = text
+                    continue
+                element = SubElement(SubElement(paragraph, run_tag), text_tag)
+                element.text = text
+                if text != text.strip():
+                    element.set(space_attr, 'preserve')
+
+
+class WritingJob:
+    """
+    Runs ResultsWriter.generate_results_document on a background thread.
+    Streamed text accumulates in `buffer`; set `cancel` to stop after the next token.
+    """
+
+    def __init__(self, writer: ResultsWriter, *args):
+        self.buffer = []
+        self.cancel = threading.Event()
+        self.result = None  # (doc_path, cost) once finished
+        self.cancelled = False
+        self.error = None
+        self._thread = threading.Thread(target=self._run, args=(writer, args), daemon=True)
+        self._thread.start()
+
+    def _run(self, writer: ResultsWriter, args: tuple):
+        try:
+            self.result = writer.generate_results_document(*args, on_token=self._on_token)
+        except GenerationCancelled:
+            self.cancelled = True
+        except Exception as e:
+            self.error = str(e)
+
+    def _on_token(self, token: str):
+        if self.cancel.is_set():
+            raise GenerationCancelled()
+        self.buffer.append(token)
+
+    @property
+    def done(self) -> bool:
+        return not self._thread.is_alive()
 
-        # Add data rows
-        for _, row in df.iterrows():
-            row_cells = table.add_row().cells
-            for i, value in enumerate(row):
-                row_cells[i].text = str(value)
+    @property
+    def text(self) -> str:
+        return ''.join(self.buffer)